@@ -0,0 +1,85 @@
+# scripts/adjust_factors.py
+# 复权因子表 (bs.query_adjust_factor) 的 schema、合并，以及基于不复权K线的本地复权计算。
+# 只需存储一份不复权K线和一张复权因子表即可按需得到前复权/后复权价格：
+# 新的除权除息事件只会在因子表中追加一行，已存储的K线历史不会因此失效。
+
+import pandas as pd
+import pyarrow as pa
+
+from kdata_schema import to_typed_table
+
+ADJUST_FACTOR_SCHEMA = pa.schema([
+    ('code', pa.dictionary(pa.int32(), pa.string())),
+    ('dividOperateDate', pa.date32()),
+    ('foreAdjustFactor', pa.float64()),
+    ('backAdjustFactor', pa.float64()),
+    ('adjustFactor', pa.float64()),
+])
+# 需要复权的价格列 (成交量、成交额、涨跌幅不复权)
+PRICE_COLUMNS = ["open", "high", "low", "close", "preclose"]
+# 复权方式与 baostock adjustflag 的对应关系
+ADJUST_MODES = {"hfq": "1", "qfq": "2"}
+
+
+def to_factor_table(df):
+    """把 baostock 返回的 (全字符串) 因子 DataFrame 转换为固定 schema 的 Arrow 表 (按 code、日期排序)"""
+    if not df.empty:
+        df = df.sort_values(['code', 'dividOperateDate'], kind='stable')
+    return to_typed_table(df, ADJUST_FACTOR_SCHEMA)
+
+
+def merge_factor_tables(tables):
+    """
+    合并多张因子表，同一 (code, 除权除息日) 以后出现的为准，结果按 code、日期排序。
+    foreAdjustFactor 是相对于"最新"后复权因子的比值，旧行中的值在有新事件后就过期了，
+    因此合并后按 backAdjustFactor / 该股票最新的 backAdjustFactor 重新计算 (保留 6 位小数，与 baostock 一致)。
+    """
+    tables = [t for t in tables if t is not None and t.num_rows > 0]
+    if not tables:
+        return ADJUST_FACTOR_SCHEMA.empty_table()
+    df = pd.concat([t.to_pandas() for t in tables], ignore_index=True)
+    df['code'] = df['code'].astype(str)
+    df = df.drop_duplicates(subset=['code', 'dividOperateDate'], keep='last')
+    df = df.sort_values(['code', 'dividOperateDate'], kind='stable')
+    latest = df.groupby('code', sort=False)['backAdjustFactor'].transform('last')
+    df['foreAdjustFactor'] = (df['backAdjustFactor'] / latest).round(6)
+    return to_factor_table(df)
+
+
+def adjust_prices(df, factors, mode):
+    """
+    按复权因子对 df (可含多只股票，需有 code、date 列) 中的价格列做复权，返回新的 DataFrame。
+    mode="hfq" (后复权): 价格 × 当日生效的 backAdjustFactor (首个除权除息日之前为 1)；
+    mode="qfq" (前复权): 价格 × 当日生效的 backAdjustFactor ÷ 该股票最新的 backAdjustFactor。
+    前复权统一由后复权因子换算，因此新增除权除息事件后无需重新下载因子的历史部分。
+    """
+    if mode not in ADJUST_MODES:
+        raise ValueError(f"不支持的复权方式: {mode} (可选: {', '.join(ADJUST_MODES)})")
+    if isinstance(factors, pa.Table):
+        factors = factors.to_pandas(date_as_object=False)
+    result = df.copy()
+    if result.empty:
+        return result
+
+    left = pd.DataFrame({
+        'code': result['code'].astype(str).to_numpy(),
+        'date': pd.to_datetime(result['date']).astype('datetime64[ns]').to_numpy(),
+        'position': range(len(result)),
+    }).sort_values('date', kind='stable')
+    right = pd.DataFrame({
+        'code': factors['code'].astype(str).to_numpy(),
+        'date': pd.to_datetime(factors['dividOperateDate']).astype('datetime64[ns]').to_numpy(),
+        'factor': factors['backAdjustFactor'].to_numpy(dtype='float64'),
+    }).sort_values('date', kind='stable')
+    merged = pd.merge_asof(left, right, on='date', by='code', direction='backward')
+    factor = merged['factor'].fillna(1.0)
+
+    if mode == "qfq":
+        latest = right.groupby('code', sort=False)['factor'].last()
+        factor = factor / merged['code'].map(latest).fillna(1.0)
+
+    factor = factor.to_numpy()[merged['position'].argsort().to_numpy()]
+    for column in PRICE_COLUMNS:
+        if column in result.columns:
+            result[column] = result[column].astype('float64') * factor
+    return result
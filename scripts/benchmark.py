@@ -0,0 +1,193 @@
+# scripts/benchmark.py
+# 离线性能基准：用 fake_baostock 替身驱动 下载 -> 收集 -> 合并 三个阶段，
+# 在不同股票数量下记录每个阶段的耗时、峰值内存 (RSS) 与产出大小，便于逐次运行对比。
+#
+# 用法:
+#     python scripts/benchmark.py                      # 默认 100 / 1000 / 5500 支股票
+#     python scripts/benchmark.py --sizes 100 --latency-ms 5 --concurrency 4
+
+import os
+import sys
+import json
+import time
+import runpy
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+
+import pandas as pd
+
+from merge_results import write_shard_metadata
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FILE = "benchmark_results.json"
+DEFAULT_SIZES = [100, 1000, 5500]
+# 包装模式下在标准输出最后一行打印峰值内存的标记
+PEAK_RSS_MARKER = "__BENCH_PEAK_RSS_KB__"
+
+
+def run_script_wrapped(script, args):
+    """包装模式：在当前进程中以 __main__ 身份运行脚本，结束后打印本进程及其子进程的峰值 RSS"""
+    sys.argv = [script] + list(args)
+    exit_code = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    finally:
+        peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        print(f"{PEAK_RSS_MARKER} {peak_kb}", flush=True)
+    sys.exit(exit_code)
+
+
+def run_stage(script, cwd, env, args=()):
+    """在独立子进程中运行一个流水线脚本，返回 {wall_seconds, peak_rss_mb}"""
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-script", os.path.join(SCRIPTS_DIR, script), "--", *args]
+    t0 = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=cwd, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    if proc.returncode != 0:
+        print(proc.stdout[-3000:], proc.stderr[-3000:])
+        raise RuntimeError(f"{script} 以状态码 {proc.returncode} 退出")
+    peak_kb = 0
+    for line in proc.stdout.splitlines():
+        if line.startswith(PEAK_RSS_MARKER):
+            peak_kb = int(line.split()[1])
+    return {"wall_seconds": round(wall, 3), "peak_rss_mb": round(peak_kb / 1024, 1)}
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def write_csv_shards(workdir, partitions):
+    """把各分区下载结果转成 merge_results.py 使用的 *_kdata.csv 分片 (不计入基准耗时)"""
+    for i in range(partitions):
+        part_dir = os.path.join(workdir, "all_data", f"kdata_part_{i}")
+        files = [os.path.join(part_dir, f) for f in os.listdir(part_dir)
+                 if f.endswith(".parquet") and not f.startswith("_")]
+        if not files:
+            continue
+        csv_dir = os.path.join(workdir, "all_data", f"csv_part_{i}")
+        os.makedirs(csv_dir, exist_ok=True)
+        df = pd.concat([pd.read_parquet(f) for f in files])
+        csv_path = os.path.join(csv_dir, f"part_{i}_kdata.csv")
+        df.to_csv(csv_path, index=False)
+        write_shard_metadata(csv_path, df)
+
+
+def run_benchmark(size, args):
+    import fake_baostock
+
+    workdir = tempfile.mkdtemp(prefix=f"bench_{size}_")
+    env = dict(os.environ,
+               BAOSTOCK_MODULE="fake_baostock",
+               PYTHONPATH=SCRIPTS_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""),
+               FAKE_BS_LATENCY_MS=str(args.latency_ms),
+               FAKE_BS_UNIVERSE=str(size),
+               DOWNLOAD_CONCURRENCY=str(args.concurrency),
+               OUTPUT_LAYOUT=args.layout,
+               SLICE_LAYOUT=args.slice_layout)
+    print(f"\n🏁 [bench] {size} 支股票，{args.partitions} 个分区，工作目录: {workdir}")
+
+    try:
+        universe = fake_baostock.make_universe(size)
+        os.makedirs(os.path.join(workdir, "tasks"))
+        for i in range(args.partitions):
+            with open(os.path.join(workdir, "tasks", f"task_slice_{i}.json"), "w", encoding="utf-8") as f:
+                json.dump(universe[i::args.partitions], f, ensure_ascii=False)
+
+        # --- 下载 (各分区依次运行，耗时取总和，峰值内存取最大) ---
+        download = {"wall_seconds": 0.0, "peak_rss_mb": 0.0, "output_bytes": 0}
+        for i in range(args.partitions):
+            stats = run_stage("download_baostock_parallel.py", workdir, dict(env, TASK_INDEX=str(i)))
+            download["wall_seconds"] = round(download["wall_seconds"] + stats["wall_seconds"], 3)
+            download["peak_rss_mb"] = max(download["peak_rss_mb"], stats["peak_rss_mb"])
+            part_dir = os.path.join(workdir, "all_data", f"kdata_part_{i}")
+            shutil.move(os.path.join(workdir, "data_slice"), part_dir)
+            download["output_bytes"] += dir_size(part_dir)
+        print(f"  -> 下载: {download}")
+
+        # --- 收集 ---
+        collect = run_stage("collect_and_compress.py", workdir, env)
+        collect["output_bytes"] = sum(os.path.getsize(os.path.join(workdir, f))
+                                      for f in ("full_kdata.parquet",) if os.path.exists(os.path.join(workdir, f)))
+        if os.path.isdir(os.path.join(workdir, "kdata_dataset")):
+            collect["output_bytes"] += dir_size(os.path.join(workdir, "kdata_dataset"))
+        print(f"  -> 收集: {collect}")
+
+        # --- 合并 CSV 分片 ---
+        write_csv_shards(workdir, args.partitions)
+        merge = run_stage("merge_results.py", workdir, env, ["--output", "full_kdata.parquet"])
+        merge["output_bytes"] = dir_size(os.path.join(workdir, "final_output"))
+        print(f"  -> 合并: {merge}")
+
+        with open(os.path.join(workdir, "data_quality_report.json"), "r", encoding="utf-8") as f:
+            total_rows = json.load(f).get("total_records", 0)
+        return {"size": size, "total_rows": total_rows,
+                "stages": {"download": download, "collect": collect, "merge": merge}}
+    finally:
+        if args.keep:
+            print(f"  -> 保留工作目录: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPTS_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="使用 fake_baostock 离线运行下载/收集/合并性能基准。")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="股票数量，可指定多个")
+    parser.add_argument("--partitions", type=int, default=1, help="模拟的下载分区 (matrix job) 数")
+    parser.add_argument("--concurrency", type=int, default=1, help="每个分区内的下载进程数")
+    parser.add_argument("--latency-ms", type=float, default=20, help="每次模拟请求的延迟 (毫秒)")
+    parser.add_argument("--layout", default="single", choices=["single", "partitioned", "both"], help="collect 输出形式")
+    parser.add_argument("--slice-layout", default="files", choices=["files", "compact"], help="下载分区的产物形式")
+    parser.add_argument("--output", default=RESULTS_FILE, help="结果追加写入的 JSON 文件")
+    parser.add_argument("--keep", action="store_true", help="保留每次运行的临时工作目录")
+    args = parser.parse_args()
+
+    sys.path.insert(0, SCRIPTS_DIR)
+    run = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": sys.version.split()[0],
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "keep")},
+        "results": [run_benchmark(size, args) for size in args.sizes],
+    }
+
+    history = []
+    if os.path.exists(args.output):
+        with open(args.output, "r", encoding="utf-8") as f:
+            history = json.load(f)
+    history.append(run)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(history, f, ensure_ascii=False, indent=2)
+
+    print("\n📊 [bench] 结果汇总 (耗时秒 / 峰值内存MB / 产出MB):")
+    for r in run["results"]:
+        cells = [f"{name}: {s['wall_seconds']:.2f}s / {s['peak_rss_mb']:.0f}MB / {s['output_bytes'] / 1e6:.1f}MB"
+                 for name, s in r["stages"].items()]
+        print(f"  - {r['size']:>5} 支 ({r['total_rows']:,} 行)  " + "  |  ".join(cells))
+    print(f"✅ [bench] 结果已追加到: {args.output}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--run-script":
+        script_args = sys.argv[4:] if len(sys.argv) > 3 and sys.argv[3] == "--" else sys.argv[3:]
+        run_script_wrapped(sys.argv[2], script_args)
+    else:
+        main()
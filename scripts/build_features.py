@@ -0,0 +1,316 @@
+# scripts/build_features.py
+# (可选阶段，在 collect_and_compress.py 之后运行) 预计算每只股票的滚动特征 (收益率、均线、波动率、
+# 成交量/换手率均值)，写成与 kdata_dataset/ 对齐的 features_dataset/ (同样按 exchange=xx/year=yyyy 分区，
+# 分区内按 code、date 排序，并附 code -> (文件, 行组) 索引)。
+# 所有特征按股票分组、基于累积和一次性向量化计算，不使用 groupby.apply / rolling。
+# INCREMENTAL=1 时只为有新K线的股票重算尾部窗口 (新K线 + 最长回看窗口)，只重写新数据落入的分区。
+
+import os
+import json
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from collect_and_compress import (DATASET_INDEX_NAME, FINAL_PARQUET_FILE, ROW_GROUP_SIZE, RowGroupWriter,
+                                  get_compression, split_by_year, write_index)
+from kdata_schema import sort_by_code_date
+from pipeline_metrics import Metrics
+
+# --- 配置 ---
+# 特征列表 "<类型>_<窗口>"，逗号分隔。类型见 FEATURE_KINDS
+FEATURE_SPEC = os.getenv("FEATURE_SPEC", "ret_1,ret_5,ret_20,ma_5,ma_20,ma_60,vol_20,vma_5,vma_20,turn_ma_5,turn_ma_20")
+# 特征类型 -> (输入列, 说明)
+FEATURE_KINDS = {
+    "ret": ("close", "n 日收益率 close / close[t-n] - 1"),
+    "ma": ("close", "n 日收盘价均线"),
+    "vol": ("close", "n 日日收益率的标准差 (样本标准差，不年化)"),
+    "vma": ("volume", "n 日成交量均值"),
+    "turn_ma": ("turn", "n 日换手率均值"),
+}
+FEATURES_DIR = "features_dataset"
+# 特征库状态: 特征列表与每只股票 [最后交易日, 行数]，增量模式据此确定每只股票需要重算的尾部
+FEATURES_STATE_FILE = "features_state.json"
+INCREMENTAL = os.getenv("INCREMENTAL", "0") == "1"
+METRICS_FILE = "_metrics_features.json"
+
+METRICS = Metrics("features")
+
+
+def parse_feature_spec(spec):
+    """解析 "ret_1,ma_20,..." 为 [(列名, 类型, 窗口)]"""
+    features = []
+    for name in (item.strip() for item in spec.split(",")):
+        if not name:
+            continue
+        kind, _, window = name.rpartition("_")
+        if kind not in FEATURE_KINDS or not window.isdigit() or int(window) < 1:
+            raise ValueError(f"不支持的特征: {name} (可选类型: {', '.join(FEATURE_KINDS)}，如 ma_20)")
+        features.append((name, kind, int(window)))
+    return features
+
+
+def lookback_rows(features):
+    """计算任一特征所需的最多前序行数 (ret_n / vol_n 需要 n 行，ma_n 需要 n-1 行)"""
+    return max((window for _, _, window in features), default=0)
+
+
+def _group_starts(codes):
+    """codes 已按股票连续排列，返回每一行所在股票的起始行号"""
+    new_code = np.r_[True, codes[1:] != codes[:-1]] if len(codes) else np.zeros(0, dtype=bool)
+    starts = np.flatnonzero(new_code)
+    return starts[np.cumsum(new_code) - 1]
+
+
+def _shift(values, row_start, n):
+    """组内向后平移 n 行 (values[i - n])，越过股票起点的位置为 NaN"""
+    idx = np.arange(len(values)) - n
+    out = np.full(len(values), np.nan)
+    valid = idx >= row_start
+    out[valid] = values[idx[valid]]
+    return out
+
+
+def _rolling_sums(values, row_start, window, *powers):
+    """组内长度为 window 的滑动窗口中 values**p 的和 (窗口内有 NaN 或不满 window 行时为 NaN)"""
+    n = len(values)
+    finite = np.isfinite(values)
+    filled = np.where(finite, values, 0.0)
+    idx = np.arange(n)
+    lo = idx + 1 - window
+    complete = lo >= row_start
+    lo = np.maximum(lo, 0)
+    count = np.r_[0, np.cumsum(finite)]
+    complete &= (count[idx + 1] - count[lo]) == window
+    results = []
+    for p in powers:
+        cs = np.r_[0.0, np.cumsum(filled ** p)]
+        results.append(np.where(complete, cs[idx + 1] - cs[lo], np.nan))
+    return results
+
+
+def compute_features(table, features):
+    """
+    table 含一只或多只完整 (或带足回看窗口) 的股票，按 (code, date) 排序；
+    返回 {特征名: float64 数组}，与 table 的行一一对应。
+    """
+    codes = table['code'].cast(pa.string()).to_numpy(zero_copy_only=False)
+    row_start = _group_starts(codes)
+    columns = {}
+
+    def column(name):
+        if name not in columns:
+            columns[name] = table[name].cast(pa.float64()).to_numpy(zero_copy_only=False)
+        return columns[name]
+
+    out = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        daily_return = None
+        for name, kind, window in features:
+            values = column(FEATURE_KINDS[kind][0])
+            if kind == "ret":
+                out[name] = values / _shift(values, row_start, window) - 1
+            elif kind == "vol":
+                if daily_return is None:
+                    daily_return = values / _shift(values, row_start, 1) - 1
+                # 收益率序列从每只股票的第二行开始，窗口起点相应后移一行
+                s1, s2 = _rolling_sums(daily_return, row_start + 1, window, 1, 2)
+                var = (s2 - s1 * s1 / window) / (window - 1) if window > 1 else np.full(len(values), np.nan)
+                out[name] = np.sqrt(np.maximum(var, 0.0))
+            else:
+                (s1,) = _rolling_sums(values, row_start, window, 1)
+                out[name] = s1 / window
+    return out
+
+
+def feature_schema(features):
+    return pa.schema([('date', pa.date32()), ('code', pa.dictionary(pa.int32(), pa.string()))]
+                     + [(name, pa.float64()) for name, _, _ in features])
+
+
+def load_state():
+    if not os.path.exists(FEATURES_STATE_FILE):
+        return None
+    with open(FEATURES_STATE_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def plan_tail(table, state_codes, lookback):
+    """
+    为一批股票 (按 code、date 排序) 确定增量计算范围，返回 (参与计算的行掩码, 需要输出的行掩码, 需整只重建的股票)。
+    每只股票已存储 rows 行、最后交易日为 last：若K线中不晚于 last 的行数仍是 rows，则只输出之后的新行，
+    并向前多取 lookback 行作为窗口；否则 (历史被全量刷新等) 整只股票重算。
+    """
+    codes = table['code'].cast(pa.string()).to_numpy(zero_copy_only=False)
+    dates = table['date'].to_numpy(zero_copy_only=False).astype("datetime64[D]")
+    n = len(codes)
+    row_start = _group_starts(codes)
+    starts = np.unique(row_start)
+    group_id = np.searchsorted(starts, row_start)
+    group_codes = codes[starts]
+
+    last = np.array([state_codes.get(c, [None, 0])[0] or "NaT" for c in group_codes], dtype="datetime64[D]")
+    old_rows = np.array([state_codes.get(c, [None, 0])[1] for c in group_codes], dtype=np.int64)
+    stored = np.bincount(group_id, weights=(dates <= last[group_id]).astype(np.float64), minlength=len(starts))
+    rebuild = stored.astype(np.int64) != old_rows
+    first_new = starts + np.where(rebuild, 0, old_rows)
+    compute_from = np.maximum(starts, first_new - lookback)
+
+    idx = np.arange(n)
+    return idx >= compute_from[group_id], idx >= first_new[group_id], set(group_codes[rebuild])
+
+
+def iter_code_tables(table):
+    """把按 code 排序的表切成每只股票一段，返回 [(code, 子表)]"""
+    codes = table['code'].cast(pa.string()).to_numpy(zero_copy_only=False)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else []
+    bounds = list(starts) + [len(codes)]
+    return [(codes[s], table.slice(s, e - s)) for s, e in zip(bounds[:-1], bounds[1:])]
+
+
+def partition_path(exchange, year):
+    return os.path.join(f"exchange={exchange}", f"year={year}", "part-0.parquet")
+
+
+def build_features():
+    features = parse_feature_spec(FEATURE_SPEC)
+    names = [name for name, _, _ in features]
+    schema = feature_schema(features)
+    lookback = lookback_rows(features)
+    input_columns = sorted({'date', 'code'} | {FEATURE_KINDS[kind][0] for _, kind, _ in features})
+
+    if not os.path.exists(FINAL_PARQUET_FILE):
+        print(f"❌ 未找到 {FINAL_PARQUET_FILE}，请先运行 collect_and_compress.py (OUTPUT_LAYOUT=single 或 both)。")
+        exit(1)
+
+    state = load_state()
+    index_path = os.path.join(FEATURES_DIR, DATASET_INDEX_NAME)
+    incremental = (INCREMENTAL and state is not None and state.get("features") == names
+                   and os.path.exists(index_path))
+    if INCREMENTAL and not incremental:
+        print("  -> ⚠️ 没有可用的特征库状态 (或特征列表已变化)，改为全量构建。")
+    state_codes = state["codes"] if incremental else {}
+    print(f"🧮 特征: {', '.join(names)} (回看 {lookback} 行)，模式: {'增量' if incremental else '全量'}")
+
+    compression = get_compression()
+    kdata = pq.ParquetFile(FINAL_PARQUET_FILE)
+    output_dir = FEATURES_DIR if incremental else FEATURES_DIR + ".tmp"
+    if not incremental and os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    writers = {}
+    new_tables = {}
+    rebuilt = set()
+    new_state = dict(state_codes)
+
+    # --- 按行组流式读取 (合并文件中一只股票不会跨行组)，每个行组一次向量化计算 ---
+    for rg in tqdm(range(kdata.metadata.num_row_groups), desc="正在计算特征"):
+        with METRICS.stage("read"):
+            table = kdata.read_row_group(rg, columns=input_columns)
+        with METRICS.stage("plan"):
+            compute_mask, output_mask, rebuild = plan_tail(table, state_codes, lookback)
+        rebuilt |= rebuild
+        if not output_mask.any():
+            continue
+        with METRICS.stage("compute"):
+            subset = table.filter(pa.array(compute_mask))
+            values = compute_features(subset, features)
+            keep = pa.array(output_mask[compute_mask])
+            result = pa.Table.from_arrays(
+                [subset['date'], subset['code']] + [pa.array(values[name]) for name in names], schema=schema
+            ).filter(keep)
+        METRICS.incr("rows_computed", subset.num_rows)
+        METRICS.incr("rows", result.num_rows)
+
+        with METRICS.stage("write"):
+            for code, code_table in iter_code_tables(result):
+                last_date = pc.max(code_table['date']).as_py().strftime('%Y-%m-%d')
+                kept_rows = 0 if code in rebuild else new_state.get(code, [None, 0])[1]
+                new_state[code] = [last_date, kept_rows + code_table.num_rows]
+                exchange = code.split('.')[0]
+                for year, year_table in split_by_year(code_table):
+                    key = (exchange, year)
+                    if incremental:
+                        new_tables.setdefault(key, []).append(year_table)
+                        continue
+                    if key not in writers:
+                        writers[key] = RowGroupWriter(os.path.join(output_dir, partition_path(*key)),
+                                                      schema, compression, ROW_GROUP_SIZE)
+                    writers[key].add(code, year_table)
+
+    with METRICS.stage("write"):
+        if incremental:
+            index = update_partitions(new_tables, rebuilt, schema, compression, index_path)
+        else:
+            for writer in writers.values():
+                writer.close()
+            index = {}
+            for key in sorted(writers):
+                rel_path = os.path.relpath(writers[key].path, output_dir)
+                for code, groups in writers[key].index.items():
+                    index.setdefault(code, []).append({"file": rel_path, "row_groups": groups})
+            os.makedirs(output_dir, exist_ok=True)
+            write_index(index, os.path.join(output_dir, DATASET_INDEX_NAME))
+            if os.path.exists(FEATURES_DIR):
+                os.rename(FEATURES_DIR, FEATURES_DIR + ".old")
+            os.rename(output_dir, FEATURES_DIR)
+            if os.path.exists(FEATURES_DIR + ".old"):
+                shutil.rmtree(FEATURES_DIR + ".old")
+
+    with open(FEATURES_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump({"features": names, "updated_at": datetime.now().isoformat(timespec="seconds"),
+                   "codes": new_state}, f, ensure_ascii=False)
+    METRICS.incr("codes_rebuilt", len(rebuilt))
+    METRICS.write(METRICS_FILE)
+    print(f"✅ 特征库已写入 '{FEATURES_DIR}'：本次计算 {METRICS.counters.get('rows_computed', 0)} 行，"
+          f"输出 {METRICS.counters.get('rows', 0)} 行新特征 ({len(rebuilt)} 支股票整只重建)。")
+
+
+def update_partitions(new_tables, rebuilt, schema, compression, index_path):
+    """
+    增量模式：只重写有新特征行或含整只重建股票的分区 —— 读出原分区，去掉重建股票的旧行，
+    追加新行后按 (code, date) 排序写回，并更新这些分区在索引中的条目。返回更新后的索引。
+    """
+    with open(index_path, "r", encoding="utf-8") as f:
+        index = json.load(f)
+    touched = set(new_tables)
+    for code in rebuilt:
+        for entry in index.get(code, []):
+            parts = entry["file"].split(os.sep)
+            touched.add((parts[0].split("=", 1)[1], int(parts[1].split("=", 1)[1])))
+
+    rebuilt_codes = pa.array(sorted(rebuilt), type=pa.string())
+    for key in sorted(touched):
+        rel_path = partition_path(*key)
+        path = os.path.join(FEATURES_DIR, rel_path)
+        tables = []
+        if os.path.exists(path):
+            existing = pq.read_table(path)
+            if len(rebuilt_codes):
+                existing = existing.filter(pc.invert(pc.is_in(existing['code'].cast(pa.string()), rebuilt_codes)))
+            tables.append(existing)
+        tables += new_tables.get(key, [])
+        merged = sort_by_code_date(pa.concat_tables([t.cast(schema) for t in tables]).unify_dictionaries())
+
+        writer = RowGroupWriter(path + ".tmp", schema, compression, ROW_GROUP_SIZE)
+        for code, code_table in iter_code_tables(merged):
+            writer.add(code, code_table)
+        writer.close()
+        os.replace(path + ".tmp", path)
+        METRICS.incr("partitions_rewritten")
+
+        for code in list(index):
+            index[code] = [e for e in index[code] if e["file"] != rel_path]
+        for code, groups in writer.index.items():
+            index.setdefault(code, []).append({"file": rel_path, "row_groups": groups})
+    index = {code: sorted(entries, key=lambda e: e["file"]) for code, entries in index.items() if entries}
+    write_index(index, index_path)
+    print(f"  -> 🔁 增量模式：重写了 {len(touched)} 个分区。")
+    return index
+
+
+if __name__ == "__main__":
+    build_features()
@@ -1,83 +1,417 @@
 # scripts/collect_and_compress.py (最终完整修复版)
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import numpy as np
 import glob
 import os
 from tqdm import tqdm
 import shutil
 import json
+import multiprocessing
+from collections import deque
 from pathlib import Path
 
+from kdata_schema import (BARS_PER_DAY, KDATA_SCHEMA, MINUTE_FREQUENCIES, TARGET_DIR_PREFIX, DEFAULT_TARGET,
+                          ensure_schema, needs_full_history, parse_targets, schema_for, target_subdir, target_suffix,
+                          to_typed_table)
+from adjust_factors import merge_factor_tables
+from quality_check import QualityChecker, check_batch
+from pipeline_metrics import Metrics, aggregate_reports
+
 # --- 配置 ---
 INPUT_BASE_DIR = "all_data"
 OUTPUT_DIR_SMALL_FILES = "kdata"
 FINAL_PARQUET_FILE = "full_kdata.parquet" 
+# (新增) 按 交易所/年份 Hive 分区的数据集目录及其 code -> (文件, 行组) 索引
+DATASET_DIR = "kdata_dataset"
+DATASET_INDEX_NAME = "_index.json"
+# 输出形式: single = 只写 full_kdata.parquet; partitioned = 只写分区数据集; both = 两者都写
+OUTPUT_LAYOUT = os.getenv("OUTPUT_LAYOUT", "single")
 QC_REPORT_FILE = "data_quality_report.json"
+# 合并文件每个行组的目标行数 (行组按整只股票切分，不会超过该值，除非单只股票本身更大)
+ROW_GROUP_SIZE = 100000
+# 分钟线的行数约为日线的 4~48 倍，单只股票往往就有数万行，使用更大的行组
+MINUTE_ROW_GROUP_SIZE = 1000000
+# 每只股票的行数，供下一次 prepare_tasks 估计下载成本
+ROW_COUNTS_FILE = "stock_row_counts.json"
+# 每只股票最后交易日的清单 (位于各目标的单股文件目录中)，供下载脚本的增量模式确定高水位
+MANIFEST_NAME = "_manifest.json"
+# (新增) 合并后的全市场复权因子表 (各下载分区的 _adjust_factors_*.parquet)，
+# 增量模式下在上一次的因子表上追加；kdata_reader 据此在本地换算前/后复权价格
+ADJUST_FACTORS_FILE = "adjust_factors.parquet"
+# (新增) 汇总所有下载分区与本阶段计时/吞吐指标的运行级报告
+METRICS_REPORT_FILE = "pipeline_metrics_report.json"
+# (新增) INCREMENTAL=1 时保留已有的 kdata/ 历史，把各分区下载的增量数据合并进去
+INCREMENTAL = os.getenv("INCREMENTAL", "0") == "1"
+# (新增) 与下载脚本一致的目标列表 "频率:复权方式,..."。每个目标产出独立的一套文件：
+# 默认目标 (d:3) 沿用上面的文件名，其余目标在文件名后加 _<频率>_<复权方式> (如 full_kdata_w_3.parquet)
+TARGETS = parse_targets(os.getenv("KDATA_TARGETS", "d:3"))
+# (新增) 下载分区可以是每只股票一个文件，也可以是压实后的 part_*.parquet + part_*.index.json
+PART_INDEX_SUFFIX = ".index.json"
+# (新增) COLLECT_SMALL_FILES=0 时不再把每只股票复制到 kdata/，直接从分区文件流式合并。
+# 增量模式需要 kdata/ 作为历史，此时总是会写出单股文件。
+COLLECT_SMALL_FILES = os.getenv("COLLECT_SMALL_FILES", "1") == "1"
+# (新增) 读取/类型转换/质检的工作进程数 (1 = 在主进程中完成)，写出仍由主进程按代码顺序进行，
+# 因此产物与进程数无关、逐字节一致
+COLLECT_WORKERS = max(1, int(os.getenv("COLLECT_WORKERS", os.cpu_count() or 1)))
+# 每个任务包含的股票数，以及每个进程最多预取的任务数 (限制主进程中待写出数据的内存)
+COLLECT_CHUNK_CODES = 64
+COLLECT_PREFETCH_PER_WORKER = 2
+
+METRICS = Metrics("collect")
+
+
+class SourceReader:
+    """
+    读取下载产物中的一只股票：source 为 (文件路径, 行组列表或 None)，None 表示整个文件。
+    缓存已打开的 ParquetFile，压实后的分区文件只解析一次元数据并按行组顺序读取。
+    """
+
+    def __init__(self):
+        self._files = {}
+
+    def read(self, source):
+        path, row_groups = source
+        if row_groups is None:
+            return pq.read_table(path)
+        if path not in self._files:
+            self._files[path] = pq.ParquetFile(path)
+        return self._files[path].read_row_groups(row_groups)
+
+
+def target_path(path, target):
+    """在默认产物名 (扩展名之前) 加上目标后缀: full_kdata.parquet -> full_kdata_w_3.parquet, kdata -> kdata_w_3"""
+    root, ext = os.path.splitext(path)
+    return root + target_suffix(target) + ext
+
+
+def in_target_dir(path, target):
+    """判断下载分区中的文件是否属于某个目标 (默认目标的文件不在任何 target=* 子目录中)"""
+    parent = os.path.basename(os.path.dirname(path))
+    if tuple(target) == DEFAULT_TARGET:
+        return not parent.startswith(TARGET_DIR_PREFIX)
+    return parent == target_subdir(target)
+
+
+def find_input_sources(base_dir, target=DEFAULT_TARGET):
+    """
+    扫描所有下载分区中属于某个目标的数据，返回 {code: (文件路径, 行组列表或 None)}。
+    压实的分区通过 part_*.index.json 定位行组；其余 .parquet 视为以股票代码命名的单股文件。
+    """
+    sources = {}
+    compacted = set()
+    index_paths = glob.glob(os.path.join(base_dir, "**", "*" + PART_INDEX_SUFFIX), recursive=True)
+    for index_path in sorted(p for p in index_paths if in_target_dir(p, target)):
+        part_dir = os.path.dirname(index_path)
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        for code, entries in index.items():
+            for entry in entries:
+                part_path = os.path.join(part_dir, entry["file"])
+                compacted.add(os.path.normpath(part_path))
+                sources[code] = (part_path, entry["row_groups"])
+    for path in sorted(glob.glob(os.path.join(base_dir, "**", "*.parquet"), recursive=True)):
+        if os.path.normpath(path) in compacted or not in_target_dir(path, target):
+            continue
+        if os.path.basename(path).startswith("_"):
+            # 下载分区中的辅助文件 (如 _adjust_factors_*.parquet)，不是单股文件
+            continue
+        sources[os.path.basename(path)[:-len(".parquet")]] = (path, None)
+    return sources
+
+
+def load_full_refresh_codes(base_dir):
+    """汇总各下载分区的 _full_refresh_*.json，返回需要用新数据替换历史的股票代码集合"""
+    codes = set()
+    for path in glob.glob(os.path.join(base_dir, "**", "_full_refresh_*.json"), recursive=True):
+        with open(path, 'r', encoding='utf-8') as f:
+            codes.update(json.load(f))
+    return codes
+
+
+# 工作进程内的全局状态，由 init_worker 设置
+_worker_reader = None
+_worker_calendar = None
+_worker_schema = KDATA_SCHEMA
+
+
+def init_worker(calendar=None, schema=KDATA_SCHEMA):
+    """工作进程初始化：每个进程持有自己的 SourceReader (及其打开的文件)、质检用的交易日历和目标 schema"""
+    global _worker_reader, _worker_calendar, _worker_schema
+    _worker_reader = SourceReader()
+    _worker_calendar = calendar
+    _worker_schema = schema
+
+
+def make_pool(calendar=None, schema=KDATA_SCHEMA):
+    """COLLECT_WORKERS > 1 时返回进程池，否则在主进程中初始化并返回 None"""
+    if COLLECT_WORKERS <= 1:
+        init_worker(calendar, schema)
+        return None
+    return multiprocessing.Pool(COLLECT_WORKERS, initializer=init_worker, initargs=(calendar, schema))
+
+
+def ordered_map(pool, func, items):
+    """
+    按 items 的顺序逐个产出 func(item) 的结果。使用进程池时最多同时提交
+    COLLECT_WORKERS * COLLECT_PREFETCH_PER_WORKER 个任务，避免结果在主进程中堆积。
+    """
+    if pool is None:
+        yield from map(func, items)
+        return
+    in_flight = deque()
+    for item in items:
+        in_flight.append(pool.apply_async(func, (item,)))
+        if len(in_flight) >= COLLECT_WORKERS * COLLECT_PREFETCH_PER_WORKER:
+            yield in_flight.popleft().get()
+    while in_flight:
+        yield in_flight.popleft().get()
+
+
+def load_chunk(chunk):
+    """
+    (工作进程) 读取并转换一组股票 [(code, source)]，设置了交易日历时顺带对这一组做向量化质检。
+    返回 ([(code, table)], 质检统计或 None, 空值计数或 None, 本任务指标)。
+    """
+    metrics = Metrics("collect-worker")
+    tables = []
+    for code, source in chunk:
+        with metrics.stage("read"):
+            table = _worker_reader.read(source)
+        if table.num_rows == 0:
+            continue
+        with metrics.stage("cast"):
+            table = ensure_schema(table, _worker_schema)
+        tables.append((code, table))
+
+    stats, null_counts = None, None
+    if _worker_calendar is not None and tables:
+        with metrics.stage("qc_check"):
+            batch = pa.concat_tables([t for _, t in tables]).to_pandas(date_as_object=False)
+            stats, null_counts = check_batch(batch, _worker_calendar)
+    return tables, stats, null_counts, metrics.to_dict()
+
+
+def collect_one(item):
+    """
+    (工作进程) 把一只股票收集到 kdata/：复制单股文件、写出压实分区中的行组，或合并进已有历史。
+    replace 为 True (全量刷新的股票、前复权目标) 时直接用新数据覆盖已有历史。
+    """
+    code, source, dest_path, replace = item
+    try:
+        if INCREMENTAL and not replace and os.path.exists(dest_path):
+            merge_into_history(_worker_reader.read(source), dest_path, _worker_schema)
+        elif source[1] is None:
+            shutil.copy2(source[0], dest_path)
+        else:
+            pq.write_table(_worker_reader.read(source), dest_path)
+    except Exception as e:
+        return f"收集 {code} ({source[0]}) 失败: {e}"
+    return None
+
+
+def merge_into_history(delta, dest_path, schema=KDATA_SCHEMA):
+    """把一只股票的增量数据 (Arrow 表) 合并到已有的历史文件中 (按日期/时间去重，新数据优先)"""
+    history = ensure_schema(pq.read_table(dest_path), schema)
+    delta = ensure_schema(delta, schema)
+    merged = pd.concat([history.to_pandas(), delta.to_pandas()], ignore_index=True)
+    merged = merged.drop_duplicates(subset=[n for n in ('date', 'time') if n in schema.names], keep='last')
+    pq.write_table(to_typed_table(merged, schema), dest_path)
+
+
+def get_compression():
+    """优先使用 zstd 压缩，当前 pyarrow 不支持时回退到 snappy"""
+    if pa.Codec.is_available('zstd'):
+        return 'zstd'
+    print("\n⚠️ 警告: 当前 pyarrow 不支持 zstd，回退到 'snappy' 压缩。")
+    return 'snappy'
+
+
+class RowGroupWriter:
+    """
+    把按股票代码顺序到来的数据攒成行组写入一个 parquet 文件。
+    行组只在股票边界处切分 (一只股票不会跨行组)，并记录每只股票所在的行组号。
+    """
 
-def run_quality_check(df):
+    def __init__(self, path, schema, compression, row_group_size=ROW_GROUP_SIZE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.row_group_size = row_group_size
+        self.writer = pq.ParquetWriter(path, schema, compression=compression)
+        self.buffer = []
+        self.buffer_codes = []
+        self.buffered_rows = 0
+        self.row_groups = 0
+        self.index = {}
+
+    def add(self, code, table):
+        if self.buffer and self.buffered_rows + table.num_rows > self.row_group_size:
+            self.flush()
+        self.buffer.append(table)
+        self.buffer_codes.append(code)
+        self.buffered_rows += table.num_rows
+
+    def flush(self):
+        if not self.buffer:
+            return
+        table = pa.concat_tables(self.buffer)
+        self.writer.write_table(table, row_group_size=max(table.num_rows, 1))
+        for code in self.buffer_codes:
+            self.index.setdefault(code, []).append(self.row_groups)
+        self.row_groups += 1
+        self.buffer = []
+        self.buffer_codes = []
+        self.buffered_rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def split_by_year(table):
+    """把一只股票 (已按日期排序) 的数据按年份切成连续的几段，返回 [(year, 子表)]"""
+    table = table.filter(pc.is_valid(table['date']))
+    if table.num_rows == 0:
+        return []
+    years = pc.year(table['date']).to_numpy()
+    unique_years, starts = np.unique(years, return_index=True)
+    bounds = list(starts) + [table.num_rows]
+    return [(int(y), table.slice(bounds[k], bounds[k + 1] - bounds[k]))
+            for k, y in enumerate(unique_years)]
+
+
+def write_index(index, path):
+    """写出 {code: [{"file": 相对路径, "row_groups": [...]}]} 索引"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    print(f"📄 [main] 行组索引已保存到: {path} ({len(index)} 支股票)")
+
+
+def write_merged_file(sources, output_path, dataset_dir=None, checker=None, target=DEFAULT_TARGET):
+    """
+    流式合并：sources 为 {code: (文件路径, 行组列表或 None)}，按股票代码顺序逐只读取
+    (单股文件或压实分区中的行组，旧版全字符串文件逐个转换类型)，
+    攒够一个行组后追加写入 ParquetWriter。
+    output_path 不为 None 时写单个合并文件；dataset_dir 不为 None 时同时写
+    exchange=xx/year=yyyy 的 Hive 分区数据集 (分区内按 code、date 排序)。
+    读取、类型转换与质检 (checker 不为 None 时) 按每 COLLECT_CHUNK_CODES 只股票一组分给进程池，
+    结果按代码顺序交回主进程，由主进程唯一地写出，因此产物与进程数无关。
+    内存占用只与在途的几组股票及单个行组的大小相关，而与全市场数据量无关；
+    分钟线等行数多的目标按 BARS_PER_DAY 相应减少每组的股票数并使用更大的行组。
+    返回 (总行数, {code: 最后交易日})。
+    """
+    compression = get_compression()
+    frequency = target[0]
+    schema = schema_for(frequency)
+    row_group_size = MINUTE_ROW_GROUP_SIZE if frequency in MINUTE_FREQUENCIES else ROW_GROUP_SIZE
+    chunk_codes = max(1, int(COLLECT_CHUNK_CODES / max(BARS_PER_DAY[frequency], 1)))
+    single_writer = None
+    partition_writers = {}
+    total_rows = 0
+    last_dates = {}
+
+    if dataset_dir is not None and os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+
+    def write_code(code, table):
+        nonlocal single_writer, total_rows
+        if output_path is not None:
+            with METRICS.stage("write_single"):
+                if single_writer is None:
+                    single_writer = RowGroupWriter(output_path, table.schema, compression, row_group_size)
+                single_writer.add(code, table)
+
+        if dataset_dir is not None:
+            with METRICS.stage("write_partitioned"):
+                exchange = code.split('.')[0]
+                for year, year_table in split_by_year(table):
+                    key = (exchange, year)
+                    if key not in partition_writers:
+                        part_path = os.path.join(dataset_dir, f"exchange={exchange}", f"year={year}", "part-0.parquet")
+                        partition_writers[key] = RowGroupWriter(part_path, table.schema, compression, row_group_size)
+                    partition_writers[key].add(code, year_table)
+
+        METRICS.incr("codes")
+        METRICS.incr("rows", table.num_rows)
+        total_rows += table.num_rows
+        max_date = pc.max(table['date']).as_py()
+        if max_date is not None:
+            last_dates[code] = max_date.strftime('%Y-%m-%d')
+
+    codes = sorted(sources)
+    chunks = [[(code, sources[code]) for code in codes[i:i + chunk_codes]]
+              for i in range(0, len(codes), chunk_codes)]
+    pool = make_pool(checker.calendar if checker is not None else None, schema)
+    try:
+        with tqdm(total=len(codes), desc=f"正在流式写入 ({COLLECT_WORKERS} 进程)") as pbar:
+            for tables, stats, null_counts, chunk_metrics in ordered_map(pool, load_chunk, chunks):
+                METRICS.merge(chunk_metrics)
+                if stats is not None:
+                    checker.add_checked(stats, null_counts)
+                for code, table in tables:
+                    write_code(code, table)
+                pbar.update(len(tables))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        with METRICS.stage("close_writers"):
+            if single_writer is not None:
+                single_writer.close()
+            for writer in partition_writers.values():
+                writer.close()
+    written = ([single_writer.path] if single_writer is not None else []) + [w.path for w in partition_writers.values()]
+    METRICS.incr("bytes_written", sum(os.path.getsize(p) for p in written))
+
+    if single_writer is not None:
+        write_index({code: [{"file": os.path.basename(output_path), "row_groups": groups}]
+                     for code, groups in single_writer.index.items()}, os.path.splitext(output_path)[0] + ".index.json")
+        print(f"\n✅ [main] 最终合并文件创建成功 (使用 {compression} 压缩)，共 {total_rows} 条记录。")
+    if partition_writers:
+        dataset_index = {}
+        for key in sorted(partition_writers):
+            writer = partition_writers[key]
+            rel_path = os.path.relpath(writer.path, dataset_dir)
+            for code, groups in writer.index.items():
+                dataset_index.setdefault(code, []).append({"file": rel_path, "row_groups": groups})
+        write_index(dataset_index, os.path.join(dataset_dir, DATASET_INDEX_NAME))
+        print(f"✅ [main] 分区数据集已写入 '{dataset_dir}' ({len(partition_writers)} 个分区)。")
+    return total_rows, last_dates
+
+
+def write_manifest(manifest, path):
+    """写出 {code: 最后交易日} 清单"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    print(f"📄 [main] 高水位清单已保存到: {path} ({len(manifest)} 支股票)")
+
+def run_quality_check(checker, report_file=QC_REPORT_FILE, row_counts_file=ROW_COUNTS_FILE):
     """
-    对合并后的 DataFrame 进行数据质量检查，并生成报告。
+    汇总流式质检累加器的结果 (全市场逐只股票对照交易日历检查)，并生成报告。
+    row_counts_file 为 None 时不写出每只股票的行数。
     """
     print("\n" + "="*50)
     print("🔍 [QC] 开始进行数据质量检查 (Data Quality Check)...")
     
     try:
-        # 确保 'date' 列是 datetime 类型以便正确排序和查找
-        if not pd.api.types.is_datetime64_any_dtype(df['date']):
-            df['date'] = pd.to_datetime(df['date'])
-        print("  -> [QC] 日期列类型检查/转换完成。")
+        with METRICS.stage("qc_report"):
+            report = checker.report()
+        print(f"  -> [QC] 已对照交易日历 ({checker.calendar_source}) 检查全部 {report.get('total_stocks', 0)} 支股票。")
 
-        report = {}
-        
-        # 1. 基础统计
-        report['total_records'] = int(len(df))
-        report['total_stocks'] = int(df['code'].nunique())
-        report['start_date'] = df['date'].min().strftime('%Y-%m-%d')
-        report['end_date'] = df['date'].max().strftime('%Y-%m-%d')
-        print("  -> [QC] 基础统计完成。")
-        
-        # 2. 完整性检查 (抽样检查一只数据最长的股票)
-        stock_lengths = df.groupby('code').size()
-        long_history_stock = stock_lengths.idxmax()
-        df_single = df[df['code'] == long_history_stock].set_index('date').sort_index()
-        expected_dates = pd.date_range(start=df_single.index.min(), end=df_single.index.max(), freq='B')
-        missing_dates = expected_dates.difference(df_single.index)
-        report['completeness_check'] = {
-            'sample_stock_for_check': long_history_stock,
-            'checked_period_years': round((df_single.index.max() - df_single.index.min()).days / 365.25, 1),
-            'business_days_missing_in_sample': int(len(missing_dates))
-        }
-        print("  -> [QC] 完整性抽样检查完成。")
-
-        # 3. 准确性检查 (异常值)
-        report['accuracy_checks'] = {
-            'negative_prices': int(df[(df['open'] < 0) | (df['high'] < 0) | (df['low'] < 0) | (df['close'] < 0)].shape[0]),
-            'zero_prices_or_volume': int(df[(df['close'] <= 0) | (df['volume'] <= 0)].shape[0]),
-            'high_lower_than_low': int(df[df['high'] < df['low']].shape[0]),
-        }
-        print("  -> [QC] 准确性（异常值）检查完成。")
-
-        # 4. 空值检查
-        nan_counts = df.isnull().sum()
-        report['nan_values_summary'] = nan_counts[nan_counts > 0].astype(int).to_dict()
-        print("  -> [QC] 空值检查完成。")
-
-        # 5. 数据分布统计
-        report['distribution_stats'] = {
-            'avg_records_per_stock': round(stock_lengths.mean(), 2),
-            'median_records_per_stock': int(stock_lengths.median()),
-            'stocks_over_15_years': int((stock_lengths > 250*15).sum()),
-            'stocks_over_10_years': int((stock_lengths > 250*10).sum()),
-            'stocks_over_5_years': int((stock_lengths > 250*5).sum()),
-            'stocks_under_1_year': int((stock_lengths < 250*1).sum())
-        }
-        print("  -> [QC] 数据分布统计完成。")
+        if row_counts_file is not None:
+            stats = checker.per_code_stats()
+            with open(row_counts_file, 'w', encoding='utf-8') as f:
+                json.dump({code: int(n) for code, n in zip(stats['code'], stats['rows'])}, f, ensure_ascii=False)
+            print(f"  -> [QC] 每只股票行数已保存到: {row_counts_file}")
 
         print("✅ [QC] 数据质量检查逻辑执行完毕。")
         
-        with open(QC_REPORT_FILE, 'w', encoding='utf-8') as f:
+        with open(report_file, 'w', encoding='utf-8') as f:
             json.dump(report, f, indent=2, ensure_ascii=False)
-        print(f"📄 [QC] 质检报告已成功保存到: {QC_REPORT_FILE}")
+        print(f"📄 [QC] 质检报告已成功保存到: {report_file}")
         
         # 在日志中打印一份简报
         print("\n--- 数据质量简报 ---")
@@ -86,6 +420,10 @@ def run_quality_check(df):
         print(f"  - 数据区间: {report.get('start_date', 'N/A')} to {report.get('end_date', 'N/A')}")
         accuracy = report.get('accuracy_checks', {})
         print(f"  - 异常数据点 (价格/成交量<=0): {accuracy.get('zero_prices_or_volume', 'N/A')}")
+        completeness = report.get('completeness_check', {})
+        print(f"  - 存在缺失交易日的股票数: {completeness.get('stocks_with_missing_days', 'N/A')}")
+        continuity = report.get('continuity_checks', {})
+        print(f"  - 涨跌幅不一致的记录数: {continuity.get('pctchg_mismatches', 'N/A')}")
         distribution = report.get('distribution_stats', {})
         print(f"  - 数据超过10年的股票数: {distribution.get('stocks_over_10_years', 'N/A')}")
         print("----------------------")
@@ -95,86 +433,127 @@ def run_quality_check(df):
         import traceback
         traceback.print_exc()
 
-def main():
+def collect_adjust_factors():
+    """合并各下载分区的复权因子表 (增量模式下并入已有的因子表)，没有因子文件时跳过"""
+    paths = sorted(glob.glob(os.path.join(INPUT_BASE_DIR, "**", "_adjust_factors_*.parquet"), recursive=True))
+    if not paths:
+        return
+    with METRICS.stage("adjust_factors"):
+        tables = []
+        if INCREMENTAL and os.path.exists(ADJUST_FACTORS_FILE):
+            tables.append(pq.read_table(ADJUST_FACTORS_FILE))
+        tables += [pq.read_table(p) for p in paths]
+        table = merge_factor_tables(tables)
+        pq.write_table(table, ADJUST_FACTORS_FILE, compression=get_compression())
+    print(f"📐 [main] 复权因子表已保存到: {ADJUST_FACTORS_FILE} ({table.num_rows} 条，"
+          f"{len(table['code'].unique())} 支股票)")
+
+
+def write_metrics_report():
+    """把各下载分区的指标文件与本阶段的指标汇总成一份运行级报告"""
+    report = aggregate_reports(os.path.join(INPUT_BASE_DIR, "**", "_metrics_*.json"), extra=METRICS.to_dict())
+    with open(METRICS_REPORT_FILE, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    slowest = report['slowest_job']
+    print(f"📊 [main] 运行级指标报告已保存到: {METRICS_REPORT_FILE} (共 {report['job_count']} 个 job，"
+          f"最慢: {slowest['job']} {slowest['wall_seconds']}s)")
+
+def collect_target(target):
     """
-    1. 收集所有分片文件。
-    2. 合并、排序并保存为一个优化的 Parquet 大文件。
-    3. 对最终数据进行质量检查。
+    收集、合并并质检一个下载目标 (频率, 复权方式) 的全部数据。
+    1. 收集所有分片文件到该目标的单股文件目录。
+    2. 按股票代码顺序流式合并为一个优化的 Parquet 大文件 (及/或分区数据集)。
+    3. 汇总写入过程中流式完成的全市场质量检查 (仅日线)。
     """
-    print("\n--- [main] 函数开始执行 ---")
-    
+    frequency, adjustflag = target
+    small_files_dir = target_path(OUTPUT_DIR_SMALL_FILES, target)
+    schema = schema_for(frequency)
+    print("\n" + "#"*50)
+    print(f"🎯 [main] 目标: 频率 {frequency}，复权方式 {adjustflag}")
+
     # --- 阶段 1: 收集所有小文件 ---
-    if os.path.exists(OUTPUT_DIR_SMALL_FILES):
-        shutil.rmtree(OUTPUT_DIR_SMALL_FILES)
-    os.makedirs(OUTPUT_DIR_SMALL_FILES)
-    print(f"  -> [main] 已创建干净的输出目录: {OUTPUT_DIR_SMALL_FILES}")
+    if INCREMENTAL and os.path.isdir(small_files_dir):
+        print(f"  -> [main] 增量模式：在已有的历史目录 {small_files_dir} 上合并新数据")
+    else:
+        if os.path.exists(small_files_dir):
+            shutil.rmtree(small_files_dir)
+        os.makedirs(small_files_dir)
+        print(f"  -> [main] 已创建干净的输出目录: {small_files_dir}")
 
-    search_pattern = os.path.join(INPUT_BASE_DIR, "**", "*.parquet")
-    file_list = glob.glob(search_pattern, recursive=True)
+    input_sources = find_input_sources(INPUT_BASE_DIR, target)
     
-    if not file_list:
+    if not input_sources and not INCREMENTAL:
         print("\n❌ [main] 致命错误: 在所有下载产物中未找到任何 .parquet 文件！脚本终止。")
         exit(1)
 
-    print(f"📦 [main] 共找到 {len(file_list)} 个股票的 Parquet 文件，开始收集...")
-    
-    for src_path in tqdm(file_list, desc="正在收集中"):
+    compacted_count = sum(1 for _, row_groups in input_sources.values() if row_groups is not None)
+    print(f"📦 [main] 共找到 {len(input_sources)} 个股票的数据 (其中 {compacted_count} 个来自压实的分区文件)。")
+
+    if COLLECT_SMALL_FILES or INCREMENTAL:
+        print(f"📦 [main] 开始收集到 '{small_files_dir}' ...")
+        full_refresh = load_full_refresh_codes(INPUT_BASE_DIR)
+        # 前复权目标每次都下载了完整历史，直接替换 (不能与旧的前复权价格合并)
+        replace_all = needs_full_history(target)
+        items = [(code, input_sources[code], os.path.join(small_files_dir, f"{code}.parquet"),
+                  replace_all or code in full_refresh)
+                 for code in sorted(input_sources)]
+        pool = make_pool(None, schema)
         try:
-            filename = os.path.basename(src_path)
-            dest_path = os.path.join(OUTPUT_DIR_SMALL_FILES, filename)
-            shutil.copy2(src_path, dest_path)
-        except Exception as e:
-            print(f"\n⚠️ 复制文件 {src_path} 失败: {e}")
-            
-    print(f"\n✅ [main] 全部 {len(file_list)} 个文件已成功收集到 '{OUTPUT_DIR_SMALL_FILES}' 目录中。")
+            with METRICS.stage("collect_files"):
+                results = pool.imap_unordered(collect_one, items, chunksize=16) if pool else map(collect_one, items)
+                for error in tqdm(results, total=len(items), desc="正在收集中"):
+                    METRICS.incr("files_collected")
+                    if error:
+                        print(f"\n⚠️ {error}")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        print(f"\n✅ [main] 全部 {len(input_sources)} 支股票已成功收集到 '{small_files_dir}' 目录中。")
+        merge_sources = {os.path.basename(p)[:-len(".parquet")]: (p, None)
+                         for p in glob.glob(os.path.join(small_files_dir, "*.parquet"))}
+    else:
+        print(f"  -> [main] COLLECT_SMALL_FILES=0：跳过复制到 '{small_files_dir}'，直接从下载分区流式合并。")
+        merge_sources = input_sources
 
     # --- 阶段 2: 创建一个经过优化的合并大文件 ---
     print("\n" + "="*50)
     print("🚀 [main] 开始创建经过压缩优化的合并文件...")
     
-    all_parquet_files = glob.glob(os.path.join(OUTPUT_DIR_SMALL_FILES, "*.parquet"))
-    
-    if not all_parquet_files:
-        print("❌ [main] 错误: 在收集目录中未找到 Parquet 文件，无法创建合并文件。脚本终止。")
+    if not merge_sources:
+        print("❌ [main] 错误: 没有可合并的 Parquet 数据，无法创建合并文件。")
         return
         
-    print(f"📦 [main] 正在读取 {len(all_parquet_files)} 个 Parquet 文件...")
-    all_dfs = [pd.read_parquet(f) for f in tqdm(all_parquet_files, desc="正在读取")]
-    
-    print("... [main] 正在合并所有数据 ...")
-    merged_df = pd.concat(all_dfs, ignore_index=True)
-    print(f"... [main] 合并完成，DataFrame 形状: {merged_df.shape}")
-
-    print("... [main] 正在进行强制数据类型转换 ...")
-    numeric_cols = ['open', 'high', 'low', 'close', 'preclose', 'volume', 'amount', 'turn', 'pctChg']
-    cols_to_convert = numeric_cols + ['isST']
-    for col in cols_to_convert:
-        if col in merged_df.columns:
-            merged_df[col] = pd.to_numeric(merged_df[col], errors='coerce')
-    if 'date' in merged_df.columns:
-        merged_df['date'] = pd.to_datetime(merged_df['date'], errors='coerce')
-    print("✅ [main] 数据类型转换完成。")
-    
-    print(f"... [main] 正在按股票代码 ('code') 对 {len(merged_df)} 条记录进行排序以优化压缩...")
-    sorted_df = merged_df.sort_values(by='code', ascending=True).reset_index(drop=True)
-    
-    output_path = FINAL_PARQUET_FILE
-    print(f"... [main] 正在将排序后的数据写入最终的合并文件: {output_path} ...")
-    
-    try:
-        sorted_df.to_parquet(output_path, index=False, compression='zstd', row_group_size=100000)
-        print("\n✅ [main] 最终合并文件创建成功 (使用 zstd 压缩)！")
-    except ImportError:
-        print("\n⚠️ 警告: 未安装 'zstandard' 库，回退到 'snappy' 压缩。")
-        sorted_df.to_parquet(output_path, index=False, compression='snappy', row_group_size=100000)
-        print("\n✅ [main] 最终合并文件创建成功 (使用 snappy 压缩)！")
+    output_path = target_path(FINAL_PARQUET_FILE, target) if OUTPUT_LAYOUT in ("single", "both") else None
+    dataset_dir = target_path(DATASET_DIR, target) if OUTPUT_LAYOUT in ("partitioned", "both") else None
+    print(f"📦 [main] 正在按股票代码顺序将 {len(merge_sources)} 支股票流式写入 (输出形式: {OUTPUT_LAYOUT}) ...")
+    # 交易日历、前收盘价连续性等检查只对日线有意义
+    checker = QualityChecker() if frequency == "d" else None
+    total_rows, last_dates = write_merged_file(merge_sources, output_path, dataset_dir, checker, target)
+
+    write_manifest(last_dates, os.path.join(small_files_dir, MANIFEST_NAME))
 
     # --- 阶段 3: 运行数据质量检查 ---
-    print("\n--- [main] 准备调用 run_quality_check 函数 ---")
-    if sorted_df is not None and not sorted_df.empty:
-        run_quality_check(sorted_df)
+    if checker is None:
+        print(f"\n  -> [main] 频率 {frequency} 不是日线，跳过交易日历质量检查。")
+    elif total_rows > 0:
+        print("\n--- [main] 准备调用 run_quality_check 函数 ---")
+        # 每只股票的行数 (下载成本模型) 只取自默认目标
+        row_counts_file = ROW_COUNTS_FILE if tuple(target) == DEFAULT_TARGET else None
+        run_quality_check(checker, target_path(QC_REPORT_FILE, target), row_counts_file)
     else:
-        print("\n⚠️ [main] 警告: 合并后的数据 (sorted_df) 为空，跳过质量检查。")
+        print("\n⚠️ [main] 警告: 合并后的数据为空，跳过质量检查。")
+
+
+def main():
+    """依次处理每个下载目标，最后汇总运行级指标报告"""
+    print("\n--- [main] 函数开始执行 ---")
+    for target in TARGETS:
+        collect_target(target)
+    collect_adjust_factors()
+
+    write_metrics_report()
         
     print("\n--- [main] 函数执行完毕 ---")
 
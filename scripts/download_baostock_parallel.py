@@ -1,44 +1,418 @@
 # scripts/download_baostock_parallel.py (最终健壮版)
 
 import os
+import glob
 import json
-import baostock as bs
+import time
+import queue
+import random
+import hashlib
+import shutil
+import importlib
+import multiprocessing
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import datetime, timedelta
 from tqdm import tqdm
 
+from kdata_schema import (DEFAULT_TARGET, fields_for, needs_full_history, parse_targets, schema_for, target_name,
+                          target_subdir, target_suffix, to_typed_table)
+from adjust_factors import merge_factor_tables, to_factor_table
+from pipeline_metrics import Metrics
+from request_scheduler import FATAL, AdaptiveLimiter, BaostockError, RequestScheduler, classify_error
+
+# 可通过 BAOSTOCK_MODULE 指定一个替身模块 (如本地假服务/桩模块)，便于离线测试
+bs = importlib.import_module(os.getenv("BAOSTOCK_MODULE", "baostock"))
+
 # --- 配置 ---
 OUTPUT_DIR = "data_slice"
 # (关键) 使用被反复验证过的、能成功获取数据的“安全”起始日期
 START_DATE = "2005-01-01"
+# 增量模式下的历史数据目录 (上一次 collect 产出的 kdata/，非默认目标为 kdata_<频率>_<复权方式>/) 及其高水位清单
+HISTORY_DIR = "kdata"
+MANIFEST_NAME = "_manifest.json"
 
 # --- 获取环境变量 & 准备目录 ---
 TASK_INDEX = int(os.getenv("TASK_INDEX", 0))
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-def get_kdata(code):
-    """获取单只股票的不复权日K线历史数据"""
-    rs = bs.query_history_k_data_plus(
-        code,
-        "date,code,open,high,low,close,preclose,volume,amount,turn,pctChg,isST",
-        start_date=START_DATE,
-        end_date="",      # 空字符串表示获取到最新
-        frequency="d",
-        adjustflag="3"  # 不复权
-    )
-    
-    if rs.error_code != '0':
-        # 如果 API 本身返回错误，在循环中打印
-        # 返回空 DataFrame，让主循环处理
-        return pd.DataFrame()
+# (新增) 下载目标列表 "频率:复权方式,..."，如 "d:3,w:3,d:2,5:3"。每只股票在同一个会话中依次下载所有目标，
+# 默认目标 (d:3) 的文件直接写在 OUTPUT_DIR 中，其余目标写在 OUTPUT_DIR/target=<频率>_<复权方式>/ 中
+TARGETS = parse_targets(os.getenv("KDATA_TARGETS", "d:3"))
+# (新增) INCREMENTAL=1 时只下载每只股票最后一个已存储交易日之后的数据
+INCREMENTAL = os.getenv("INCREMENTAL", "0") == "1"
+# (新增) 分区内并发的下载进程数，每个进程持有独立的 baostock 会话
+CONCURRENCY = max(1, int(os.getenv("DOWNLOAD_CONCURRENCY", 1)))
+# 工作进程等待结果时的轮询间隔 (秒)，用于发现意外退出的进程
+RESULT_POLL_SECONDS = 5
+# (新增) 每个分区的检查点日志 (追加写入的 JSON Lines)，重启时据此跳过已完成的股票
+CHECKPOINT_DIR = "checkpoints"
+JOURNAL_FILE = os.path.join(CHECKPOINT_DIR, f"journal_{TASK_INDEX}.jsonl")
+# 检查点日志只在同一轮运行、同一个任务分片内有效：日志首行记录 "<运行标识>:<分片哈希>"，
+# 不匹配时 (如复用的工作目录里残留着前一天的日志) 把旧日志改名为 .stale 后重新开始。
+# 运行标识取 DOWNLOAD_RUN_ID，其次为 GitHub Actions 的 GITHUB_RUN_ID (重跑失败的 job 时不变)，本地默认为当天日期
+RUN_ID = os.getenv("DOWNLOAD_RUN_ID") or os.getenv("GITHUB_RUN_ID") or datetime.now().strftime("%Y-%m-%d")
+# 单只股票的最大尝试次数，以及指数退避的基础等待时间 (秒)
+MAX_ATTEMPTS = max(1, int(os.getenv("DOWNLOAD_MAX_ATTEMPTS", 3)))
+RETRY_BACKOFF_SECONDS = 2
+# 这些状态表示该股票在本轮已经处理完毕，重启后无需再下载
+COMPLETED_STATUSES = ("done", "empty", "up_to_date")
+# (新增) 本分区的计时/吞吐指标文件，随分区产物一起上传，由 collect 阶段汇总
+METRICS_FILE = os.path.join(OUTPUT_DIR, f"_metrics_download_{TASK_INDEX}.json")
+# (新增) 分区产物形式: files = 每只股票一个 parquet; compact = 下载结束后压实为
+# 一个 parquet (每只股票一个行组) + code -> 行组 索引，避免上传/下载数千个小文件
+SLICE_LAYOUT = os.getenv("SLICE_LAYOUT", "files")
+# (新增) DOWNLOAD_ADJUST_FACTORS=1 时同时下载复权因子 (bs.query_adjust_factor)，本分区的因子表写到
+# ADJUST_FACTORS_FILE，由 collect 阶段合并；前/后复权价格由不复权K线在本地换算，无需再按 adjustflag 重复下载
+DOWNLOAD_ADJUST_FACTORS = os.getenv("DOWNLOAD_ADJUST_FACTORS", "0") == "1"
+ADJUST_FACTORS_FILE = os.path.join(OUTPUT_DIR, f"_adjust_factors_{TASK_INDEX}.parquet")
+# 每只股票的因子表在写检查点日志之前先落盘到这里 (与日志一起随检查点恢复)，
+# 进程中途被杀时，日志中已完成的股票不会丢失因子；结束时再合并为 ADJUST_FACTORS_FILE
+ADJUST_FACTOR_PARTS_DIR = os.path.join(CHECKPOINT_DIR, f"adjust_factors_{TASK_INDEX}")
+# 全量下载复权因子时的起始日期 (早于 A 股开市，确保拿到全部除权除息事件)
+ADJUST_FACTOR_START_DATE = "1990-01-01"
+# (新增) prepare_tasks 标记为需要全量刷新的股票 (上市日期变化/FULL_REFRESH=1) 的清单，
+# collect 阶段据此用新数据替换而不是合并已有历史
+FULL_REFRESH_FILE = os.path.join(OUTPUT_DIR, f"_full_refresh_{TASK_INDEX}.json")
+PART_FILE_NAME = f"part_{TASK_INDEX}.parquet"
+PART_INDEX_NAME = f"part_{TASK_INDEX}.index.json"
+for _target in TARGETS:
+    os.makedirs(os.path.join(OUTPUT_DIR, target_subdir(_target)), exist_ok=True)
+os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+
+# 每个进程各自累计指标；工作进程退出时把自己的指标回传给主进程合并
+METRICS = Metrics(f"download-{TASK_INDEX}")
+# 每个工作进程的请求调度器 (共享分区内的自适应限流器)，由 download_worker 设置；
+# 在工作进程之外直接调用 get_kdata 等函数时由 get_scheduler 按需创建一个单并发的默认调度器
+SCHEDULER = None
+
+
+def history_dir(target):
+    return HISTORY_DIR + target_suffix(target)
+
+
+def slice_dir(target):
+    return os.path.join(OUTPUT_DIR, target_subdir(target))
+
+
+def load_manifest(target=DEFAULT_TARGET):
+    """读取 collect 阶段为某个目标写出的 {code: 最后日期} 清单，不存在时返回空字典"""
+    manifest_file = os.path.join(history_dir(target), MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def journal_key(task_file):
+    """本轮检查点日志的标识: 运行标识 + 任务分片文件的内容哈希"""
+    with open(task_file, "rb") as f:
+        digest = hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+    return f"{RUN_ID}:{digest}"
+
+
+def load_journal(key):
+    """
+    读取检查点日志，返回 {code: 最后一条记录}；日志末尾被截断的半行会被忽略。
+    日志首行的标识与 key 不一致 (属于另一轮运行或另一个任务分片) 时，旧日志改名为 .stale 并返回空字典。
+    """
+    journal = {}
+    if not os.path.exists(JOURNAL_FILE):
+        return journal
+    header = None
+    with open(JOURNAL_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if header is None:
+                header = record.get("journal")
+                if header != key:
+                    break
+                continue
+            journal[record["code"]] = record
+    if header != key:
+        os.replace(JOURNAL_FILE, JOURNAL_FILE + ".stale")
+        print(f"🗑️ 检查点日志属于另一轮运行或另一个任务分片 ({header} ≠ {key})，已改名为 {JOURNAL_FILE}.stale。")
+        return {}
+    return journal
+
 
-    data_list = []
-    while rs.next():
-        data_list.append(rs.get_row_data())
+def open_journal(key):
+    """以追加方式打开检查点日志；新日志先写入标识行"""
+    is_new = not os.path.exists(JOURNAL_FILE) or os.path.getsize(JOURNAL_FILE) == 0
+    journal_file = open(JOURNAL_FILE, "a", encoding="utf-8")
+    if is_new:
+        journal_file.write(json.dumps({"journal": key}, ensure_ascii=False) + "\n")
+        journal_file.flush()
+    return journal_file
+
+
+def append_journal(journal_file, code, status, detail, attempts):
+    """向检查点日志追加一条记录并立即落盘"""
+    record = {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "code": code,
+        "status": status,
+        "rows": detail if status != "error" else 0,
+        "attempts": attempts,
+    }
+    if status == "error":
+        record["error"] = detail
+    journal_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+    journal_file.flush()
+
+
+def get_high_water_mark(code, manifest, target=DEFAULT_TARGET):
+    """
+    返回某只股票在某个目标下本地已存储的最后交易日 ('YYYY-MM-DD')。
+    优先使用清单，其次读取历史目录中该股票 parquet 的 date 列；都没有则返回 None。
+    """
+    if code in manifest:
+        return manifest[code]
+    history_path = os.path.join(history_dir(target), f"{code}.parquet")
+    if not os.path.exists(history_path):
+        return None
+    dates = pd.to_datetime(pd.read_parquet(history_path, columns=["date"])["date"], errors="coerce")
+    if dates.dropna().empty:
+        return None
+    return dates.max().strftime("%Y-%m-%d")
+
+
+def get_scheduler():
+    """返回当前进程的请求调度器，尚未设置时创建默认调度器 (调用方仍需先 bs.login())"""
+    global SCHEDULER
+    if SCHEDULER is None:
+        SCHEDULER = RequestScheduler(AdaptiveLimiter(1), bs.login, METRICS)
+    return SCHEDULER
+
+
+def get_kdata(code, start_date=START_DATE, frequency="d", adjustflag="3"):
+    """
+    获取单只股票某个频率/复权方式的K线数据 (默认为从 START_DATE 起的全部不复权日线)。
+    请求经由调度器限流与分类重试；API 最终仍返回错误时抛出 BaostockError，不再当作空数据吞掉。
+    """
+    with METRICS.stage("query"):
+        rs = get_scheduler().call(
+            bs.query_history_k_data_plus,
+            code,
+            fields_for(frequency),
+            start_date=start_date,
+            end_date="",      # 空字符串表示获取到最新
+            frequency=frequency,
+            adjustflag=adjustflag  # 1 = 后复权, 2 = 前复权, 3 = 不复权
+        )
+
+    with METRICS.stage("fetch_rows"):
+        columns = fetch_columns(rs)
         
-    if not data_list:
+    if not columns or not columns[rs.fields[0]]:
         return pd.DataFrame()
         
-    return pd.DataFrame(data_list, columns=rs.fields)
+    with METRICS.stage("build_frame"):
+        return pd.DataFrame(columns, columns=rs.fields)
+
+
+def fetch_columns(rs):
+    """
+    按页批量读取结果集并转置为列 ({字段名: 字符串列表})。
+    直接取 rs.data 中尚未消费的整页数据，而不是逐行调用 get_row_data()；
+    rs.next() 只用来触发翻页。结果集没有 data/cur_row_num 属性时退回逐行读取。
+    翻页请求失败时 rs.next() 会设置 rs.error_code 并返回 False，此时抛出 BaostockError，
+    避免把截断的历史当作完整数据写出。
+    """
+    if hasattr(rs, "data") and hasattr(rs, "cur_row_num"):
+        pages = []
+        while rs.next():
+            pages.append(rs.data[rs.cur_row_num:])
+            rs.cur_row_num = len(rs.data)
+    else:
+        rows = []
+        while rs.next():
+            rows.append(rs.get_row_data())
+        pages = [rows]
+    if rs.error_code != '0':
+        METRICS.incr("page_errors")
+        raise BaostockError(rs.error_code, f"翻页失败: {rs.error_msg}", classify_error(rs.error_code, rs.error_msg))
+
+    columns = {f: [] for f in rs.fields}
+    for page in pages:
+        for field, values in zip(rs.fields, zip(*page)):
+            columns[field].extend(values)
+    return columns
+
+
+def get_adjust_factors(code, start_date=ADJUST_FACTOR_START_DATE):
+    """获取单只股票在 start_date 之后的复权因子 (Arrow 表)；API 出错时抛出 BaostockError，由调用方重试"""
+    with METRICS.stage("query_adjust_factor"):
+        rs = get_scheduler().call(bs.query_adjust_factor, code=code, start_date=start_date, end_date="")
+    columns = fetch_columns(rs)
+    return to_factor_table(pd.DataFrame(columns, columns=rs.fields))
+
+
+def download_one(s, manifests, today):
+    """
+    在当前会话中依次下载并保存一只股票的所有目标，返回 (status, detail, 复权因子表或 None)。
+    status 取值: done (至少一个目标有新数据) / up_to_date / empty；detail 为各目标的总行数。
+    有新K线且开启了 DOWNLOAD_ADJUST_FACTORS 时，顺带下载同一区间内的复权因子
+    (除权除息日一定是有K线的交易日，因此增量模式下只需从最早的增量起点查起)。
+    任一目标出错时直接抛出异常，整只股票由调用方重试。
+    """
+    code = s["code"]
+    statuses = []
+    fetched_from = []
+    total_rows = 0
+    for target in TARGETS:
+        frequency, adjustflag = target
+        start_date = START_DATE
+        # 前复权目标的历史会随新的除权除息事件整体变化，始终整段下载，由 collect 替换已有历史
+        if INCREMENTAL and not s.get("full_refresh") and not needs_full_history(target):
+            last_date = get_high_water_mark(code, manifests[target], target)
+            if last_date:
+                start_date = (pd.Timestamp(last_date) + timedelta(days=1)).strftime("%Y-%m-%d")
+            if start_date > today:
+                statuses.append("up_to_date")
+                continue
+
+        df = get_kdata(code, start_date, frequency, adjustflag)
+        if df.empty:
+            # 增量区间内没有新K线 (节假日/停牌)，不是错误
+            statuses.append("up_to_date" if start_date != START_DATE else "empty")
+            continue
+
+        # 在下载端就解析为该频率固定的 schema (date32 / float64 / int64 / bool / 字典编码 code)
+        output_path = os.path.join(slice_dir(target), f"{code}.parquet")
+        with METRICS.stage("write_parquet"):
+            pq.write_table(to_typed_table(df, schema_for(frequency)), output_path)
+        METRICS.incr("rows", len(df))
+        METRICS.incr(f"rows_{target_name(target)}", len(df))
+        METRICS.incr("bytes_written", os.path.getsize(output_path))
+        statuses.append("done")
+        fetched_from.append(start_date)
+        total_rows += len(df)
+
+    if "done" not in statuses:
+        return ("up_to_date" if "up_to_date" in statuses else "empty"), 0, None
+
+    factors = None
+    if DOWNLOAD_ADJUST_FACTORS:
+        full_history = not INCREMENTAL or START_DATE in fetched_from
+        factors = get_adjust_factors(code, ADJUST_FACTOR_START_DATE if full_history else min(fetched_from))
+        METRICS.incr("adjust_factor_rows", factors.num_rows)
+    return "done", total_rows, factors
+
+
+def save_factor_part(code, factors):
+    """把一只股票的因子表写到检查点目录 (须在该股票的日志记录之前调用)"""
+    os.makedirs(ADJUST_FACTOR_PARTS_DIR, exist_ok=True)
+    pq.write_table(factors, os.path.join(ADJUST_FACTOR_PARTS_DIR, f"{code}.parquet"))
+
+
+def save_adjust_factors():
+    """把本轮 (含重跑前已完成的股票) 落盘的每股因子表合并后写出为分区因子表"""
+    parts = sorted(glob.glob(os.path.join(ADJUST_FACTOR_PARTS_DIR, "*.parquet")))
+    table = merge_factor_tables([pq.read_table(p) for p in parts])
+    pq.write_table(table, ADJUST_FACTORS_FILE)
+    print(f"📐 复权因子已保存到 {ADJUST_FACTORS_FILE} (共 {table.num_rows} 条)。")
+
+
+def compact_partition(directory):
+    """
+    把目录中的单股文件压实为 part_<TASK_INDEX>.parquet (按代码排序，每只股票一个行组) 并写出
+    {code: [{"file", "row_groups"}]} 索引，成功后删除单股文件。
+    重跑时已有的压实文件中的股票会一并保留，本次新下载的单股文件优先。
+    """
+    part_file = os.path.join(directory, PART_FILE_NAME)
+    part_index_file = os.path.join(directory, PART_INDEX_NAME)
+    sources = {}
+    if os.path.exists(part_file) and os.path.exists(part_index_file):
+        with open(part_index_file, "r", encoding="utf-8") as f:
+            for code, entries in json.load(f).items():
+                sources[code] = (part_file, entries[0]["row_groups"])
+    loose_files = [os.path.join(directory, f) for f in os.listdir(directory)
+                   if f.endswith(".parquet") and not f.startswith(("part_", "_"))]
+    for path in loose_files:
+        sources[os.path.basename(path)[:-len(".parquet")]] = (path, None)
+    if not loose_files:
+        return
+
+    tmp_path = part_file + ".tmp"
+    part = pq.ParquetFile(part_file) if os.path.exists(part_file) else None
+    index = {}
+    writer = None
+    try:
+        for code in sorted(sources):
+            path, row_groups = sources[code]
+            table = pq.read_table(path) if row_groups is None else part.read_row_groups(row_groups)
+            if table.num_rows == 0:
+                continue
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression="zstd" if pa.Codec.is_available("zstd") else "snappy")
+            writer.write_table(table, row_group_size=table.num_rows)
+            index[code] = [{"file": PART_FILE_NAME, "row_groups": [len(index)]}]
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is not None:
+        os.replace(tmp_path, part_file)
+    with open(part_index_file, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    for path in loose_files:
+        os.remove(path)
+    METRICS.incr("codes_compacted", len(index))
+    print(f"🗜️ 已把 {len(loose_files)} 个单股文件压实到 {part_file} (共 {len(index)} 支股票)。")
+
+
+def download_with_retry(s, manifests, today):
+    """
+    带抖动的指数退避重试地下载一只股票，返回 ("result", code, name, status, detail, attempts, 复权因子表或 None)。
+    单次请求层面的限流/网络/会话错误已由调度器重试过，这里兜底整只股票的重试；参数错误等不可重试的错误直接放弃。
+    所有尝试都失败时 status 为 error，detail 为最后一次的错误信息。
+    """
+    code = s["code"]
+    name = s.get("name", "")
+    error = None
+    t0 = time.perf_counter()
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            status, detail, factors = download_one(s, manifests, today)
+            METRICS.observe("code_latency_seconds", time.perf_counter() - t0)
+            return ("result", code, name, status, detail, attempt, factors)
+        except Exception as e:
+            error = str(e)
+            if isinstance(e, BaostockError) and e.kind == FATAL:
+                break
+            if attempt < MAX_ATTEMPTS:
+                METRICS.incr("retries")
+                time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+    METRICS.observe("code_latency_seconds", time.perf_counter() - t0)
+    return ("result", code, name, "error", error, attempt, None)
+
+
+def download_worker(worker_id, task_queue, result_queue, manifests, today, limiter):
+    """
+    下载工作进程：登录一个独立的 baostock 会话，不断从任务队列领取股票，
+    直到取到 None 为止。所有请求都经过分区共享的限流器 limiter；会话失效时由调度器重新登录。
+    退出前登出，并放回一条 ("exit", worker_id, 错误信息, 本进程指标)。
+    """
+    global SCHEDULER
+    SCHEDULER = RequestScheduler(limiter, bs.login, METRICS)
+    with METRICS.stage("login"):
+        lg = bs.login()
+    if lg.error_code != '0':
+        result_queue.put(("exit", worker_id, f"登录失败: {lg.error_msg}", METRICS.to_dict()))
+        return
+    try:
+        while True:
+            s = task_queue.get()
+            if s is None:
+                break
+            result_queue.put(download_with_retry(s, manifests, today))
+    finally:
+        with METRICS.stage("logout"):
+            bs.logout()
+    result_queue.put(("exit", worker_id, None, METRICS.to_dict()))
 
 
 def main():
@@ -60,34 +434,123 @@ def main():
         print(f"\n✅ 分区 {TASK_INDEX + 1} 任务完成。")
         return
 
-    lg = bs.login()
-    if lg.error_code != '0':
-        print(f"❌ 分区 {TASK_INDEX + 1} 登录失败: {lg.error_msg}")
-        exit(1)
+    print(f"🎯 下载目标 (频率:复权方式): {', '.join(f'{f}:{a}' for f, a in TARGETS)}")
+    manifests = {target: {} for target in TARGETS}
+    if INCREMENTAL:
+        manifests = {target: load_manifest(target) for target in TARGETS}
+        print(f"🔁 增量模式：已加载 {sum(len(m) for m in manifests.values())} 条高水位记录，仅下载缺失区间。")
+        full_history_targets = [f"{f}:{a}" for f, a in TARGETS if needs_full_history((f, a))]
+        if full_history_targets:
+            print(f"  -> ⚠️ 前复权目标 {', '.join(full_history_targets)} 每次都整段下载；"
+                  f"可改为下载不复权K线并设置 DOWNLOAD_ADJUST_FACTORS=1，在本地换算前复权价格。")
+        full_refresh_codes = [s["code"] for s in subset if s.get("full_refresh")]
+        if full_refresh_codes:
+            with open(FULL_REFRESH_FILE, "w", encoding="utf-8") as f:
+                json.dump(full_refresh_codes, f, ensure_ascii=False)
+            print(f"🔄 其中 {len(full_refresh_codes)} 支股票需要全量刷新。")
+    today = datetime.now().strftime("%Y-%m-%d")
 
-    total_downloaded_count = 0
-    try:
-        for s in tqdm(subset, desc=f"分区 {TASK_INDEX + 1} 下载进度"):
-            code = s["code"]
-            name = s.get("name", "")
-            
+    # --- 读取检查点日志：跳过已完成的股票，只处理未开始或失败过的 ---
+    key = journal_key(task_file)
+    journal = load_journal(key)
+    if not journal:
+        # 没有可恢复的日志时，残留的每股因子表属于另一轮运行
+        shutil.rmtree(ADJUST_FACTOR_PARTS_DIR, ignore_errors=True)
+    completed = {code: r for code, r in journal.items() if r["status"] in COMPLETED_STATUSES}
+    pending = [s for s in subset if s["code"] not in completed]
+    total_downloaded_count = sum(1 for s in subset if completed.get(s["code"], {}).get("status") == "done")
+    up_to_date_count = sum(1 for s in subset if completed.get(s["code"], {}).get("status") == "up_to_date")
+    if journal:
+        retrying = sum(1 for s in pending if journal.get(s["code"], {}).get("status") == "error")
+        print(f"♻️ 从检查点恢复：跳过 {len(subset) - len(pending)} 支已完成的股票，重试 {retrying} 支失败的股票。")
+
+    # --- 启动工作进程池，每个进程独立登录/登出 ---
+    worker_count = min(CONCURRENCY, len(pending))
+    print(f"🧵 启动 {worker_count} 个下载进程 (每个进程一个 baostock 会话)。")
+    # 分区内所有下载进程共享的令牌桶 + 在途上限，按错误与延迟信号自适应调整 (AIMD)
+    limiter = AdaptiveLimiter(worker_count)
+    task_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    for s in pending:
+        task_queue.put(s)
+    for _ in range(worker_count):
+        task_queue.put(None)
+
+    workers = [
+        multiprocessing.Process(target=download_worker,
+                                args=(i, task_queue, result_queue, manifests, today, limiter),
+                                daemon=True)
+        for i in range(worker_count)
+    ]
+    for w in workers:
+        w.start()
+
+    failed_count = 0
+    login_failures = 0
+    finished = 0
+    running = worker_count
+    with tqdm(total=len(pending), desc=f"分区 {TASK_INDEX + 1} 下载进度") as pbar, \
+            open_journal(key) as journal_file:
+        # 一直收取到所有工作进程都退出为止，确保它们随 exit 消息回传的指标不会丢失
+        while running > 0:
             try:
-                df = get_kdata(code)
-                if not df.empty:
-                    output_path = f"{OUTPUT_DIR}/{code}.parquet"
-                    df.to_parquet(output_path, index=False)
-                    total_downloaded_count += 1
-            except Exception as e:
-                print(f"\n  -> ❌ 在处理 {name} ({code}) 时出错: {e}")
-    finally:
-        bs.logout()
+                msg = result_queue.get(timeout=RESULT_POLL_SECONDS)
+            except queue.Empty:
+                # 工作进程可能被意外杀死，没有机会放回 exit 消息
+                if not any(w.is_alive() for w in workers):
+                    break
+                continue
+
+            if msg[0] == "exit":
+                running -= 1
+                METRICS.merge(msg[3])
+                if msg[2]:
+                    login_failures += 1
+                    print(f"\n  -> ❌ 下载进程 {msg[1]} {msg[2]}")
+                continue
+
+            _, code, name, status, detail, attempts, factors = msg
+            if factors is not None:
+                save_factor_part(code, factors)
+            append_journal(journal_file, code, status, detail, attempts)
+            METRICS.incr(f"codes_{status}")
+            finished += 1
+            pbar.update(1)
+            if status == "done":
+                total_downloaded_count += 1
+            elif status == "up_to_date":
+                up_to_date_count += 1
+            elif status == "error":
+                failed_count += 1
+                print(f"\n  -> ❌ 在处理 {name} ({code}) 时出错 (已尝试 {attempts} 次): {detail}")
+
+    for w in workers:
+        w.join(timeout=RESULT_POLL_SECONDS)
+    METRICS.incr("codes_skipped_from_checkpoint", len(subset) - len(pending))
+    print(f"🚦 限流器最终状态: {limiter.rate:.1f} 次/秒，在途上限 {limiter.concurrency_limit}/{worker_count}。")
+    METRICS.set_gauge("final_rate_limit", round(limiter.rate, 2))
+    if DOWNLOAD_ADJUST_FACTORS:
+        save_adjust_factors()
+    if SLICE_LAYOUT == "compact":
+        with METRICS.stage("compact"):
+            for target in TARGETS:
+                compact_partition(slice_dir(target))
+    METRICS.write(METRICS_FILE)
+
+    if worker_count > 0 and login_failures == worker_count:
+        print(f"❌ 分区 {TASK_INDEX + 1} 所有下载进程均登录失败。")
+        exit(1)
 
     # --- (关键) 增加最终检查 ---
     print(f"\n✅ 分区 {TASK_INDEX + 1} 任务完成。")
     print(f"   - 负责股票数: {len(subset)}")
     print(f"   - 成功下载文件数: {total_downloaded_count}")
+    if failed_count:
+        print(f"   - 失败股票数: {failed_count} (已记录到 {JOURNAL_FILE}，重新运行即可只重试这些股票)")
+    if INCREMENTAL:
+        print(f"   - 已是最新、无需下载数: {up_to_date_count}")
 
-    if total_downloaded_count == 0 and len(subset) > 0:
+    if total_downloaded_count == 0 and up_to_date_count == 0 and len(subset) > 0:
         print("\n" + "="*60)
         print("❌ 致命警告: 本分区有 {len(subset)} 个任务，但没有成功下载任何一个文件！")
         print("   这通常意味着 Baostock API 的参数（如 start_date）或环境存在问题。")
@@ -0,0 +1,349 @@
+# scripts/fake_baostock.py
+# 离线替身：模拟 baostock 模块的接口 (login/logout/query_*)，返回确定性的合成K线，
+# 并按配置模拟每次请求的网络延迟。通过 BAOSTOCK_MODULE=fake_baostock 注入到下载脚本中。
+#
+# 环境变量:
+#   FAKE_BS_LATENCY_MS   每次请求 (含翻页) 的模拟延迟，默认 20 毫秒
+#   FAKE_BS_END_DATE     合成数据的最后一个交易日，默认 2025-06-30 (改变它只会增减尾部K线，之前的历史保持不变)
+#   FAKE_BS_SEED         随机种子，默认 0
+#   FAKE_BS_UNIVERSE     query_all_stock / query_stock_basic 返回的股票数，默认 5500
+#   FAKE_BS_ERROR_RATE   每次查询返回网络错误 (10002007) 的概率，默认 0
+#   FAKE_BS_PAGE_ERROR_RATE  每次翻页 (第二页起) 失败、结果集被截断并置为网络错误的概率，默认 0
+#   FAKE_BS_RATE_LIMIT   每个会话每秒允许的查询次数，超过时返回限流错误，默认 0 (不限)
+#   FAKE_BS_SESSION_CALLS  会话在多少次查询后失效 (返回 10001001 用户未登录，需重新 login)，默认 0 (不失效)
+
+import os
+import time
+import zlib
+import random
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+LATENCY_SECONDS = float(os.getenv("FAKE_BS_LATENCY_MS", 20)) / 1000
+END_DATE = os.getenv("FAKE_BS_END_DATE", "2025-06-30")
+SEED = int(os.getenv("FAKE_BS_SEED", 0))
+UNIVERSE_SIZE = int(os.getenv("FAKE_BS_UNIVERSE", 5500))
+ERROR_RATE = float(os.getenv("FAKE_BS_ERROR_RATE", 0))
+PAGE_ERROR_RATE = float(os.getenv("FAKE_BS_PAGE_ERROR_RATE", 0))
+RATE_LIMIT = float(os.getenv("FAKE_BS_RATE_LIMIT", 0))
+SESSION_CALLS = int(os.getenv("FAKE_BS_SESSION_CALLS", 0))
+# 与真实 baostock 一致的分页大小
+PER_PAGE_COUNT = 10000
+# 模拟数据中最早的交易日
+HISTORY_START = "1999-01-04"
+# 合成数据的固定生成区间终点与上市年份上限：随机序列总在 [HISTORY_START, HISTORY_END] 上生成后再按
+# FAKE_BS_END_DATE 截断，因此调整截止日只会增减尾部的K线，不会改变之前的任何一根 (供增量路径测试)
+HISTORY_END = "2030-12-31"
+LAST_LISTING_YEAR = 2025
+# 与真实 baostock 一致，分钟线只提供近几年的数据
+MINUTE_HISTORY_START = "2019-01-02"
+# A 股交易时段 (分钟，自零点起): 9:30-11:30, 13:00-15:00
+TRADING_SESSIONS = [(9 * 60 + 30, 11 * 60 + 30), (13 * 60, 15 * 60)]
+
+
+class ResultData:
+    """模拟 baostock.data.resultset.ResultData：按页保存在 data 中，next() 读完一页后自动翻页"""
+
+    def __init__(self, rows=None, fields=None, error_code='0', error_msg='success'):
+        self.error_code = error_code
+        self.error_msg = error_msg
+        self.fields = fields or []
+        self.per_page_count = PER_PAGE_COUNT
+        self.cur_page_num = 1
+        self.cur_row_num = 0
+        self._all_rows = rows or []
+        self.data = self._all_rows[:PER_PAGE_COUNT]
+
+    def next(self):
+        if self.error_code != '0':
+            return False
+        if self.cur_row_num < len(self.data):
+            return True
+        start = self.cur_page_num * self.per_page_count
+        if start >= len(self._all_rows):
+            return False
+        _simulate_latency()
+        if PAGE_ERROR_RATE and _error_rng.random() < PAGE_ERROR_RATE:
+            # 与真实 baostock 一致：翻页请求失败时把错误写回结果集并停止迭代
+            self.error_code = "10002007"
+            self.error_msg = "网络接收错误"
+            return False
+        self.cur_page_num += 1
+        self.data = self._all_rows[start:start + self.per_page_count]
+        self.cur_row_num = 0
+        return len(self.data) > 0
+
+    def get_row_data(self):
+        row = self.data[self.cur_row_num]
+        self.cur_row_num += 1
+        return row
+
+    def get_data(self):
+        rows = []
+        while self.next():
+            rows.append(self.get_row_data())
+        return pd.DataFrame(rows, columns=self.fields)
+
+
+# 当前进程的会话状态 (每个下载进程各自 login，与真实 baostock 一致)
+_session = {"logged_in": False, "calls": 0, "recent": deque()}
+_error_rng = random.Random(SEED ^ os.getpid())
+
+
+def _inject_error():
+    """按配置模拟会话失效、限流与网络错误，返回一个出错的 ResultData；正常时返回 None"""
+    if not _session["logged_in"]:
+        return ResultData(error_code="10001001", error_msg="用户未登录")
+    _session["calls"] += 1
+    if SESSION_CALLS and _session["calls"] > SESSION_CALLS:
+        _session["logged_in"] = False
+        return ResultData(error_code="10001001", error_msg="用户未登录")
+    if RATE_LIMIT:
+        now = time.monotonic()
+        recent = _session["recent"]
+        while recent and now - recent[0] > 1:
+            recent.popleft()
+        recent.append(now)
+        if len(recent) > RATE_LIMIT:
+            return ResultData(error_code="10002010", error_msg="请求过于频繁，请稍后再试")
+    if ERROR_RATE and _error_rng.random() < ERROR_RATE:
+        return ResultData(error_code="10002007", error_msg="网络接收错误")
+    return None
+
+
+def _simulate_latency():
+    if LATENCY_SECONDS > 0:
+        time.sleep(LATENCY_SECONDS)
+
+
+def _rng(code):
+    return np.random.default_rng(zlib.crc32(code.encode()) ^ SEED)
+
+
+def make_universe(n):
+    """生成 n 个股票代码 (沪、深、北交所按大致比例分布)，供基准测试构造任务列表"""
+    codes = []
+    for i in range(n):
+        if i % 10 < 4:
+            codes.append(f"sh.{600000 + i:06d}")
+        elif i % 10 < 9:
+            codes.append(f"sz.{i:06d}")
+        else:
+            codes.append(f"bj.{830000 + i:06d}")
+    return [{"code": c, "name": f"合成股票{i}"} for i, c in enumerate(codes)]
+
+
+def list_date(code):
+    """合成的上市日期：约 40% 的股票在 2005 年前上市 (完整历史)，其余均匀分布在之后的年份"""
+    rng = _rng(code)
+    if rng.random() < 0.4:
+        return pd.Timestamp(HISTORY_START)
+    return pd.Timestamp(year=int(rng.integers(2005, LAST_LISTING_YEAR + 1)), month=int(rng.integers(1, 13)), day=1)
+
+
+def _end_date(end_date):
+    """请求的截止日与 FAKE_BS_END_DATE 中较早的一个"""
+    return min(pd.Timestamp(end_date or END_DATE), pd.Timestamp(END_DATE))
+
+
+def _listed_days(code):
+    """固定生成区间内该股票上市后的全部交易日 (与截止日无关)"""
+    days = pd.bdate_range(pd.Timestamp(HISTORY_START), pd.Timestamp(HISTORY_END))
+    return days[days >= list_date(code)]
+
+
+def _kdata_frame(code, start_date, end_date):
+    """
+    生成一只股票在区间内的日K线 (价格为确定性的随机游走，preclose/pctChg 自洽)。
+    随机数在固定生成区间上一次抽取，再截断到截止日，因此同一天的K线与截止日无关。
+    """
+    days = _listed_days(code)
+    rng = _rng(code)
+    n = len(days)
+    if (days <= _end_date(end_date)).sum() == 0:
+        # 上市日期晚于数据截止日的股票没有任何K线
+        return pd.DataFrame(columns=["date", "code", "open", "high", "low", "close", "preclose",
+                                     "volume", "amount", "turn", "pctChg", "isST"])
+    returns = rng.normal(0, 0.02, n).clip(-0.1, 0.1)
+    close = np.round(10 * np.exp(np.cumsum(returns)), 2)
+    preclose = np.r_[close[0], close[:-1]]
+    open_ = np.round(preclose * (1 + rng.normal(0, 0.005, n)), 2)
+    high = np.maximum.reduce([open_, close, preclose]) + 0.01
+    low = np.minimum.reduce([open_, close, preclose]) - 0.01
+    volume = rng.integers(10_000, 50_000_000, n)
+    frame = pd.DataFrame({
+        "date": days.strftime("%Y-%m-%d"),
+        "code": code,
+        "open": open_, "high": high, "low": low, "close": close, "preclose": preclose,
+        "volume": volume,
+        "amount": volume * close,
+        "turn": rng.uniform(0.1, 5, n),
+        "pctChg": (close / preclose - 1) * 100,
+        "isST": "0",
+    })
+    frame = frame[days <= _end_date(end_date)]
+    return frame[frame["date"] >= start_date]
+
+
+def _adjust_events(code, end_date=None):
+    """
+    合成的除权除息事件：上市后平均约每 1.5 年一次，返回 (日期数组, 后复权因子数组)。
+    后复权因子为各次事件比例的累积乘积，前复权因子 = 后复权因子 / 最新的后复权因子。
+    事件在固定生成区间上抽取后再截断到截止日，截止日之前的事件日期与因子保持不变。
+    """
+    days = _listed_days(code)
+    if len(days) < 2:
+        return days[:0], np.array([])
+    rng = np.random.default_rng(zlib.crc32(f"{code}/adjust".encode()) ^ SEED)
+    count = max(1, int(len(days) / 375))
+    event_days = days[np.sort(rng.choice(np.arange(1, len(days)), size=count, replace=False))]
+    back = np.round(np.cumprod(rng.uniform(1.01, 1.08, count)), 6)
+    keep = event_days <= _end_date(end_date)
+    return event_days[keep], back[keep]
+
+
+def _apply_adjustment(daily, code, adjustflag, end_date):
+    """按 adjustflag 把不复权日线换算为后复权 (1) 或前复权 (2) 价格"""
+    if adjustflag not in ("1", "2") or daily.empty:
+        return daily
+    event_days, back = _adjust_events(code, end_date)
+    if len(back) == 0:
+        return daily
+    position = np.searchsorted(event_days.strftime("%Y-%m-%d").to_numpy(), daily["date"].to_numpy(), side="right")
+    factor = np.r_[1.0, back][position]
+    if adjustflag == "2":
+        factor = factor / back[-1]
+    daily = daily.copy()
+    for col in ("open", "high", "low", "close", "preclose"):
+        daily[col] = daily[col] * factor
+    return daily
+
+
+def _period_frame(daily, rule):
+    """
+    把日线聚合为周线 (rule="W") 或月线 (rule="M")，日期取该周期内最后一个交易日。
+    与真实 baostock 一致，周/月线只在周期的最后一个交易日发布，尚未结束的当前周期不输出。
+    """
+    if daily.empty:
+        return daily
+    period = pd.to_datetime(daily["date"]).dt.to_period(rule)
+    current = period.iloc[-1]
+    if pd.Timestamp(daily["date"].iloc[-1]) < pd.offsets.BDay().rollback(current.end_time.normalize()):
+        complete = (period != current).to_numpy()
+        daily, period = daily[complete], period[complete]
+        if daily.empty:
+            return daily
+    grouped = daily.groupby(period.to_numpy(), sort=True)
+    frame = pd.DataFrame({
+        "date": grouped["date"].last(),
+        "code": grouped["code"].first(),
+        "open": grouped["open"].first(),
+        "high": grouped["high"].max(),
+        "low": grouped["low"].min(),
+        "close": grouped["close"].last(),
+        "volume": grouped["volume"].sum(),
+        "amount": grouped["amount"].sum(),
+        "turn": grouped["turn"].sum(),
+    }).reset_index(drop=True)
+    prev_close = frame["close"].shift(1).fillna(grouped["preclose"].first().iloc[0])
+    frame["pctChg"] = (frame["close"] / prev_close - 1) * 100
+    return frame
+
+
+def _minute_frame(daily, frequency):
+    """在每个交易日内生成 frequency 分钟的K线，收盘价在开盘价与日收盘价之间随机游走"""
+    daily = daily[daily["date"] >= MINUTE_HISTORY_START]
+    step = int(frequency)
+    bar_ends = np.concatenate([np.arange(start + step, end + 1, step) for start, end in TRADING_SESSIONS])
+    bars = len(bar_ends)
+    n = len(daily)
+    if n == 0:
+        return pd.DataFrame(columns=["date", "time", "code", "open", "high", "low", "close", "volume", "amount"])
+    rng = np.random.default_rng(zlib.crc32(f"{daily['code'].iloc[0]}/{frequency}".encode()) ^ SEED)
+    path = np.cumsum(rng.normal(0, 0.002, (n, bars)), axis=1)
+    path -= path[:, -1:] * np.linspace(0, 1, bars)
+    day_open = daily["open"].to_numpy()[:, None]
+    day_close = daily["close"].to_numpy()[:, None]
+    close = np.round(day_open + (day_close - day_open) * np.linspace(0, 1, bars) + day_open * path, 2)
+    open_ = np.c_[day_open, close[:, :-1]]
+    volume = np.maximum(daily["volume"].to_numpy()[:, None] // bars, 100) * np.ones(bars, dtype=np.int64)
+    dates = np.repeat(daily["date"].to_numpy(), bars)
+    clock = np.tile([f"{m // 60:02d}{m % 60:02d}00000" for m in bar_ends], n)
+    return pd.DataFrame({
+        "date": dates,
+        "time": np.char.add(np.char.replace(dates.astype(str), "-", ""), clock),
+        "code": daily["code"].iloc[0],
+        "open": open_.ravel(), "high": np.maximum(open_, close).ravel() + 0.01,
+        "low": np.minimum(open_, close).ravel() - 0.01, "close": close.ravel(),
+        "volume": volume.ravel(), "amount": (volume * close).ravel(),
+    })
+
+
+def login(*args, **kwargs):
+    _simulate_latency()
+    _session.update(logged_in=True, calls=0)
+    return ResultData()
+
+
+def logout(*args, **kwargs):
+    _session["logged_in"] = False
+    return ResultData()
+
+
+def query_history_k_data_plus(code, fields, start_date="", end_date="", frequency="d", adjustflag="3"):
+    _simulate_latency()
+    error = _inject_error()
+    if error is not None:
+        return error
+    field_list = [f.strip() for f in fields.split(",")]
+    frame = _apply_adjustment(_kdata_frame(code, HISTORY_START, end_date), code, adjustflag, end_date)
+    if frequency in ("w", "m"):
+        frame = _period_frame(frame, frequency.upper())
+    elif frequency != "d":
+        frame = _minute_frame(frame, frequency)
+    frame = frame[frame["date"] >= (start_date or HISTORY_START)]
+    text = {}
+    for f in field_list:
+        col = frame[f] if f in frame.columns else pd.Series("", index=frame.index)
+        if col.dtype.kind == "f":
+            text[f] = np.char.mod("%.4f", col.to_numpy()).tolist()
+        else:
+            text[f] = col.astype(str).tolist()
+    rows = [list(r) for r in zip(*(text[f] for f in field_list))]
+    return ResultData(rows, field_list)
+
+
+def query_adjust_factor(code, start_date="", end_date=""):
+    _simulate_latency()
+    error = _inject_error()
+    if error is not None:
+        return error
+    event_days, back = _adjust_events(code)
+    fields = ["code", "dividOperateDate", "foreAdjustFactor", "backAdjustFactor", "adjustFactor"]
+    dates = event_days.strftime("%Y-%m-%d").tolist()
+    rows = [[code, d, f"{b / back[-1]:.6f}", f"{b:.6f}", f"{b:.6f}"] for d, b in zip(dates, back)
+            if d >= (start_date or HISTORY_START) and (not end_date or d <= end_date)]
+    return ResultData(rows, fields)
+
+
+def query_trade_dates(start_date=None, end_date=None):
+    _simulate_latency()
+    days = pd.date_range(start_date or HISTORY_START, end_date or END_DATE)
+    rows = [[d.strftime("%Y-%m-%d"), "1" if d.dayofweek < 5 else "0"] for d in days]
+    return ResultData(rows, ["calendar_date", "is_trading_day"])
+
+
+def query_all_stock(day=None):
+    _simulate_latency()
+    rows = [[s["code"], "1", s["name"]] for s in make_universe(UNIVERSE_SIZE)]
+    return ResultData(rows, ["code", "tradeStatus", "code_name"])
+
+
+def query_stock_basic(code="", code_name=""):
+    _simulate_latency()
+    universe = make_universe(UNIVERSE_SIZE)
+    rows = [[s["code"], s["name"], list_date(s["code"]).strftime("%Y-%m-%d"), "", "1", "1"]
+            for s in universe if not code or s["code"] == code]
+    return ResultData(rows, ["code", "code_name", "ipoDate", "outDate", "type", "status"])
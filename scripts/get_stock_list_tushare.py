@@ -64,7 +64,20 @@ def main():
 
     # 2. 检查结果并决定下一步行动
     if latest_stock_list:
-        # 如果成功获取到新列表，则使用它
+        # 如果成功获取到新列表，先与已有文件对比，只有列表确实变化时才重写 (避免无意义的提交/缓存失效)
+        previous_list = []
+        if os.path.exists(OUTPUT_FILE):
+            with open(OUTPUT_FILE, "r", encoding="utf-8") as f:
+                previous_list = json.load(f)
+        previous = {s["code"]: s["name"] for s in previous_list}
+        latest = {s["code"]: s["name"] for s in latest_stock_list}
+        added = latest.keys() - previous.keys()
+        removed = previous.keys() - latest.keys()
+        renamed = [c for c in latest.keys() & previous.keys() if latest[c] != previous[c]]
+        print(f"🔍 与已有列表对比: 新增 {len(added)} 支，移除 {len(removed)} 支，更名 {len(renamed)} 支。")
+        if previous_list == latest_stock_list:
+            print(f"✅ 股票列表没有变化，保留现有的 {OUTPUT_FILE}。")
+            return
         print(f"📦 使用最新的 Tushare 列表 ({len(latest_stock_list)} 条)，正在写入 {OUTPUT_FILE}...")
         with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
             json.dump(latest_stock_list, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,214 @@
+# scripts/kdata_reader.py
+# 本地K线读取接口：在 collect 阶段产出的数据上按股票/日期/列读取，并缓存已解码的单股数据。
+#
+# 用法:
+#     from kdata_reader import get_bars
+#     df = get_bars(["sh.600000", "sz.000001"], start="2020-01-01", end="2020-12-31",
+#                   columns=["close", "volume"])
+#     qfq = get_bars("sh.600000", adjust="qfq")  # 前复权 (需要 adjust_factors.parquet)
+
+import os
+import json
+from collections import OrderedDict
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from adjust_factors import adjust_prices
+from kdata_schema import DEFAULT_TARGET, target_suffix
+
+# --- 配置 ---
+# 数据根目录 (即运行 collect_and_compress.py 的目录)
+KDATA_ROOT = os.getenv("KDATA_ROOT", ".")
+# 已解码数据缓存的内存上限 (MB)
+CACHE_MB = int(os.getenv("KDATA_CACHE_MB", 512))
+
+# 与 collect_and_compress.py 的输出保持一致
+DATASET_DIR = "kdata_dataset"
+DATASET_INDEX_NAME = "_index.json"
+FINAL_PARQUET_FILE = "full_kdata.parquet"
+FINAL_INDEX_FILE = "full_kdata.index.json"
+SMALL_FILES_DIR = "kdata"
+ADJUST_FACTORS_FILE = "adjust_factors.parquet"
+
+
+class KDataReader:
+    """
+    按以下顺序解析数据来源：
+      1. 分区数据集 kdata_dataset/ (通过 _index.json 定位到 文件 + 行组)
+      2. 合并文件 full_kdata.parquet (通过索引或行组的 code 统计信息定位行组)
+      3. 每只股票一个文件的 kdata/<code>.parquet
+    每只股票解码后的 DataFrame 放入 LRU 缓存，按内存占用淘汰。
+    前复权/后复权价格由缓存中的不复权数据与 adjust_factors.parquet 按需换算。
+    """
+
+    def __init__(self, root=KDATA_ROOT, cache_bytes=CACHE_MB * 1024 * 1024, target=DEFAULT_TARGET):
+        self.root = root
+        # 读取哪个下载目标 (频率, 复权方式) 的产物，与 collect_and_compress.py 的命名一致
+        self.suffix = target_suffix(target)
+        self.adjustflag = tuple(target)[1]
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._files = {}
+        self._index = None
+        self._factors = None
+        self.hits = 0
+        self.misses = 0
+
+    # --- 数据来源解析 ---
+
+    def _load_index(self):
+        """加载 code -> [(文件路径, [行组])] 索引；没有索引文件时返回空字典"""
+        dataset_dir = os.path.join(self.root, DATASET_DIR + self.suffix)
+        dataset_index = os.path.join(dataset_dir, DATASET_INDEX_NAME)
+        if os.path.exists(dataset_index):
+            return self._read_index_file(dataset_index, dataset_dir)
+        final_index = os.path.join(self.root, self._target_file(FINAL_INDEX_FILE))
+        if os.path.exists(final_index):
+            return self._read_index_file(final_index, self.root)
+        return {}
+
+    def _read_index_file(self, index_path, base_dir):
+        with open(index_path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        return {code: [(os.path.join(base_dir, e["file"]), e["row_groups"]) for e in entries]
+                for code, entries in raw.items()}
+
+    def _locate(self, code):
+        """返回 [(文件路径, 行组列表或 None)]，None 表示读取整个文件"""
+        if self._index is None:
+            self._index = self._load_index()
+        if code in self._index:
+            return self._index[code]
+        final_file = os.path.join(self.root, self._target_file(FINAL_PARQUET_FILE))
+        if not self._index and os.path.exists(final_file):
+            return self._locate_by_range(final_file, code)
+        small_file = os.path.join(self.root, SMALL_FILES_DIR + self.suffix, f"{code}.parquet")
+        if os.path.exists(small_file):
+            return [(small_file, None)]
+        return []
+
+    def _target_file(self, name):
+        """full_kdata.parquet -> full_kdata_w_3.parquet (默认目标不变)"""
+        stem, _, ext = name.partition(".")
+        return f"{stem}{self.suffix}.{ext}"
+
+    def _locate_by_range(self, path, code):
+        """没有索引文件时，根据每个行组 code 列的 min/max 统计信息筛选行组"""
+        parquet_file = self._open(path)
+        code_col = parquet_file.schema_arrow.get_field_index("code")
+        groups = []
+        for rg in range(parquet_file.metadata.num_row_groups):
+            stats = parquet_file.metadata.row_group(rg).column(code_col).statistics
+            if stats is not None and stats.has_min_max and stats.min <= code <= stats.max:
+                groups.append(rg)
+        return [(path, groups)] if groups else []
+
+    def _open(self, path):
+        """缓存 ParquetFile 对象，避免重复解析文件尾部的元数据"""
+        if path not in self._files:
+            self._files[path] = pq.ParquetFile(path)
+        return self._files[path]
+
+    # --- 解码与缓存 ---
+
+    def _decode(self, code, columns):
+        """读取一只股票的完整历史 (只读取需要的列与行组)"""
+        read_columns = None if columns is None else list(dict.fromkeys(["date", "code"] + list(columns)))
+        tables = []
+        for path, row_groups in self._locate(code):
+            parquet_file = self._open(path)
+            if row_groups is None:
+                table = parquet_file.read(columns=read_columns)
+            else:
+                table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+                table = table.filter(pc.equal(table["code"].cast(pa.string()), code))
+            tables.append(table)
+        if not tables:
+            return pd.DataFrame(columns=read_columns or [])
+        table = pa.concat_tables(tables) if len(tables) > 1 else tables[0]
+        df = table.to_pandas(date_as_object=False)
+        return df.sort_values([c for c in ("date", "time") if c in df.columns], kind="stable").reset_index(drop=True)
+
+    def _get_code_frame(self, code, columns):
+        key = (code, None if columns is None else tuple(columns))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return self._cache[key][0]
+
+        self.misses += 1
+        df = self._decode(code, columns)
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if nbytes <= self.cache_bytes:
+            self._cache[key] = (df, nbytes)
+            self._cached_bytes += nbytes
+            while self._cached_bytes > self.cache_bytes:
+                _, (_, evicted_bytes) = self._cache.popitem(last=False)
+                self._cached_bytes -= evicted_bytes
+        return df
+
+    def _load_factors(self):
+        if self._factors is None:
+            path = os.path.join(self.root, ADJUST_FACTORS_FILE)
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"未找到复权因子表 {path}，请在下载时设置 DOWNLOAD_ADJUST_FACTORS=1")
+            factors = pq.read_table(path).to_pandas(date_as_object=False)
+            factors["code"] = factors["code"].astype(str)
+            self._factors = factors
+        return self._factors
+
+    def get_bars(self, codes, start=None, end=None, columns=None, adjust=None):
+        """
+        返回 codes 在 [start, end] 区间内的K线 (含 date、code 两列及 columns 指定的列)。
+        codes 可以是单个代码或代码列表；start/end 为 None 表示不限。
+        adjust 为 "qfq" (前复权) / "hfq" (后复权) 时，价格列按复权因子换算；None 为不复权。
+        只有不复权 (adjustflag=3) 的目标可以换算，其余目标的价格已经复权过。
+        """
+        if adjust is not None and self.adjustflag != "3":
+            raise ValueError(f"目标的复权方式为 {self.adjustflag}，价格已复权，不能再按 adjust={adjust} 换算 "
+                             f"(请读取不复权目标，或直接使用该目标的价格)")
+        if isinstance(codes, str):
+            codes = [codes]
+        frames = []
+        for code in codes:
+            df = self._get_code_frame(code, columns)
+            if df.empty:
+                continue
+            lo = 0 if start is None else df["date"].searchsorted(pd.Timestamp(start), side="left")
+            hi = len(df) if end is None else df["date"].searchsorted(pd.Timestamp(end), side="right")
+            frames.append(df.iloc[lo:hi])
+        if not frames:
+            return pd.DataFrame()
+        bars = pd.concat(frames, ignore_index=True)
+        if adjust is not None:
+            factors = self._load_factors()
+            bars = adjust_prices(bars, factors[factors["code"].isin(codes)], adjust)
+        return bars
+
+    def cache_info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._cache),
+            "cached_bytes": self._cached_bytes,
+            "budget_bytes": self.cache_bytes,
+        }
+
+    def clear_cache(self):
+        self._cache.clear()
+        self._cached_bytes = 0
+
+
+_default_reader = None
+
+
+def get_bars(codes, start=None, end=None, columns=None, adjust=None):
+    """使用进程内共享的默认读取器 (及其缓存) 读取K线，参数见 KDataReader.get_bars"""
+    global _default_reader
+    if _default_reader is None:
+        _default_reader = KDataReader()
+    return _default_reader.get_bars(codes, start, end, columns, adjust)
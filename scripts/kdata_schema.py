@@ -0,0 +1,217 @@
+# scripts/kdata_schema.py
+# K线数据的固定 Arrow schema (日/周/月/分钟线各一套)，以及下载目标 (频率, 复权方式) 的解析，
+# 下载、收集与读取阶段共用，保证各阶段的列类型与产物命名一致。
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+KDATA_SCHEMA = pa.schema([
+    ('date', pa.date32()),
+    ('code', pa.dictionary(pa.int32(), pa.string())),
+    ('open', pa.float64()),
+    ('high', pa.float64()),
+    ('low', pa.float64()),
+    ('close', pa.float64()),
+    ('preclose', pa.float64()),
+    ('volume', pa.int64()),
+    ('amount', pa.float64()),
+    ('turn', pa.float64()),
+    ('pctChg', pa.float64()),
+    ('isST', pa.bool_()),
+])
+
+# 周线/月线没有 preclose 与 isST
+PERIOD_SCHEMA = pa.schema([
+    ('date', pa.date32()),
+    ('code', pa.dictionary(pa.int32(), pa.string())),
+    ('open', pa.float64()),
+    ('high', pa.float64()),
+    ('low', pa.float64()),
+    ('close', pa.float64()),
+    ('volume', pa.int64()),
+    ('amount', pa.float64()),
+    ('turn', pa.float64()),
+    ('pctChg', pa.float64()),
+])
+
+# 分钟线多一个 time 字段 (baostock 返回 "YYYYMMDDHHMMSSsss" 格式的字符串)，没有换手率与涨跌幅
+MINUTE_SCHEMA = pa.schema([
+    ('date', pa.date32()),
+    ('time', pa.timestamp('ms')),
+    ('code', pa.dictionary(pa.int32(), pa.string())),
+    ('open', pa.float64()),
+    ('high', pa.float64()),
+    ('low', pa.float64()),
+    ('close', pa.float64()),
+    ('volume', pa.int64()),
+    ('amount', pa.float64()),
+])
+
+# 每个交易日大致的K线条数 (相对日线)，用于估计下载成本与设置行组大小
+BARS_PER_DAY = {"d": 1, "w": 0.2, "m": 0.05, "5": 48, "15": 16, "30": 8, "60": 4}
+MINUTE_FREQUENCIES = ("5", "15", "30", "60")
+# 复权方式: 1 = 后复权, 2 = 前复权, 3 = 不复权
+ADJUST_FLAGS = ("1", "2", "3")
+# 前复权价格以最新的复权因子为基准，新的除权除息事件会改写之前所有的价格，
+# 因此这类目标在增量模式下也整段重新下载并替换已有历史 (更省的做法是下载不复权K线 + 复权因子在本地换算)
+FULL_HISTORY_ADJUST_FLAGS = ("2",)
+# 默认目标 (日线, 不复权) 的产物沿用原有的文件名，其余目标在文件名后加 _<频率>_<复权方式>
+DEFAULT_TARGET = ("d", "3")
+
+
+def schema_for(frequency):
+    """返回某个频率的K线 schema"""
+    if frequency == "d":
+        return KDATA_SCHEMA
+    if frequency in ("w", "m"):
+        return PERIOD_SCHEMA
+    if frequency in MINUTE_FREQUENCIES:
+        return MINUTE_SCHEMA
+    raise ValueError(f"不支持的K线频率: {frequency}")
+
+
+def fields_for(frequency):
+    """返回某个频率传给 query_history_k_data_plus 的字段列表"""
+    return ",".join(schema_for(frequency).names)
+
+
+def parse_targets(spec):
+    """
+    解析形如 "d:3,w:3,d:2,5:3" 的目标列表 (频率:复权方式，逗号分隔)，返回去重后的 [(frequency, adjustflag)]。
+    省略复权方式时默认为 3 (不复权)。
+    """
+    targets = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        frequency, _, adjustflag = item.partition(":")
+        target = (frequency.strip(), adjustflag.strip() or "3")
+        schema_for(target[0])
+        if target[1] not in ADJUST_FLAGS:
+            raise ValueError(f"不支持的复权方式: {target[1]}")
+        if target not in targets:
+            targets.append(target)
+    return targets or [DEFAULT_TARGET]
+
+
+def needs_full_history(target):
+    """该目标是否每次都必须下载完整历史 (不能在已存储的历史后追加)"""
+    return target[1] in FULL_HISTORY_ADJUST_FLAGS
+
+
+def target_name(target):
+    return f"{target[0]}_{target[1]}"
+
+
+def target_suffix(target):
+    """默认目标返回空字符串，其余目标返回 "_<频率>_<复权方式>"，用于拼接各阶段的产物名"""
+    return "" if tuple(target) == DEFAULT_TARGET else f"_{target_name(target)}"
+
+
+# 下载分区中非默认目标的子目录前缀 (默认目标的文件直接放在分区根目录)
+TARGET_DIR_PREFIX = "target="
+
+
+def target_subdir(target):
+    """下载分区内某个目标的子目录名，默认目标为空字符串"""
+    return "" if tuple(target) == DEFAULT_TARGET else TARGET_DIR_PREFIX + target_name(target)
+
+
+def _parse_string_column(strings, arrow_type):
+    """
+    直接在 Arrow 中把字符串列解析为目标类型 (空字符串视为 null)，不经过 pandas。
+    遇到无法解析的值时抛出 pa.ArrowInvalid，由调用方退回到逐值容错解析。
+    """
+    strings = pc.if_else(pc.equal(strings, ""), pa.scalar(None, pa.string()), strings)
+    if pa.types.is_dictionary(arrow_type):
+        return strings.dictionary_encode().cast(arrow_type)
+    if pa.types.is_string(arrow_type) or pa.types.is_date(arrow_type):
+        return strings.cast(arrow_type)
+    if pa.types.is_timestamp(arrow_type):
+        # 分钟线的 time: 前 14 位为 YYYYMMDDHHMMSS，末尾 3 位毫秒恒为 0
+        seconds = pc.utf8_slice_codeunits(strings, 0, 14)
+        return pc.strptime(seconds, format="%Y%m%d%H%M%S", unit=arrow_type.unit)
+    if pa.types.is_boolean(arrow_type):
+        try:
+            # "0"/"1" 或由 CSV 写回的 "True"/"False"
+            return strings.cast(arrow_type)
+        except pa.ArrowInvalid:
+            return pc.not_equal(strings.cast(pa.float64()), 0)
+    if pa.types.is_integer(arrow_type):
+        try:
+            return strings.cast(arrow_type)
+        except pa.ArrowInvalid:
+            # 形如 "12345.0" 的整数
+            return pc.round(strings.cast(pa.float64())).cast(arrow_type)
+    return strings.cast(arrow_type)
+
+
+def _to_arrow_column(values, arrow_type):
+    """把一列 (字符串或已有类型均可) 转换为指定的 Arrow 类型，无法解析的值记为 null"""
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        if not pa.types.is_string(values.type):
+            return values.cast(arrow_type)
+        try:
+            return _parse_string_column(values, arrow_type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            values = pd.Series(values.to_pylist(), dtype="object")
+    elif isinstance(values, (list, tuple)) or pd.api.types.is_string_dtype(values):
+        try:
+            return _parse_string_column(pa.array(values, type=pa.string(), from_pandas=True), arrow_type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            values = pd.Series(values, dtype="object")
+
+    if pa.types.is_timestamp(arrow_type) and pd.api.types.is_object_dtype(values):
+        parsed = pd.to_datetime(values.astype('string').str[:14], format="%Y%m%d%H%M%S", errors='coerce')
+        return pa.array(parsed, from_pandas=True).cast(arrow_type)
+    if pa.types.is_date(arrow_type) or pa.types.is_timestamp(arrow_type):
+        parsed = pd.to_datetime(values, errors='coerce')
+        return pa.array(parsed, from_pandas=True).cast(arrow_type)
+    if pa.types.is_dictionary(arrow_type):
+        strings = pa.array(values.astype('string'), type=pa.string(), from_pandas=True)
+        return strings.dictionary_encode().cast(arrow_type)
+    if pa.types.is_string(arrow_type):
+        return pa.array(values.astype('string'), type=arrow_type, from_pandas=True)
+
+    numeric = pd.to_numeric(values, errors='coerce')
+    if pa.types.is_boolean(arrow_type):
+        return pa.array(numeric.astype('Int64') != 0, type=arrow_type, from_pandas=True)
+    if pa.types.is_integer(arrow_type):
+        return pa.array(numeric.round().astype('Int64'), type=arrow_type, from_pandas=True)
+    return pa.array(numeric.astype('float64'), type=arrow_type, from_pandas=True)
+
+
+def to_typed_table(df, schema=KDATA_SCHEMA):
+    """
+    把 baostock 返回的 (全字符串) DataFrame 或 {字段: 列 (列表/Series/Arrow 数组)} 字典转换为固定 schema 的 Arrow 表，
+    并按日期 (及时间) 排序。
+    空字符串 (如停牌日的换手率) 会被解析为 null；缺失的列整列填 null。
+    """
+    names = list(df.columns) if isinstance(df, pd.DataFrame) else list(df)
+    num_rows = len(df) if isinstance(df, pd.DataFrame) else len(df[names[0]]) if names else 0
+    columns = []
+    for field in schema:
+        if field.name in names:
+            columns.append(_to_arrow_column(df[field.name], field.type))
+        else:
+            columns.append(pa.nulls(num_rows, type=field.type))
+    table = pa.Table.from_arrays(columns, schema=schema)
+    sort_keys = [(name, 'ascending') for name in ('date', 'time') if name in schema.names]
+    if sort_keys:
+        table = table.sort_by(sort_keys)
+    return table
+
+
+def sort_by_code_date(table):
+    """按 (code, date) 稳定排序 (字典编码的 code 列不能直接用 sort_by)"""
+    keys = pa.table({'code': table['code'].cast(pa.string()), 'date': table['date']})
+    return table.take(pc.sort_indices(keys, sort_keys=[('code', 'ascending'), ('date', 'ascending')]))
+
+
+def ensure_schema(table, schema=KDATA_SCHEMA):
+    """已是目标 schema 的表原样返回；旧版全字符串文件则重新解析"""
+    if table.schema.equals(schema, check_metadata=False):
+        return table
+    return to_typed_table(table.to_pandas(), schema)
@@ -1,74 +1,344 @@
 # scripts/merge_results.py (重构版)
+# 合并各分区的 CSV 分片：先按内容哈希与每个分片的 {code: [最早日期, 最晚日期, 行数]} 元数据
+# 跳过完全相同或已被后写入分片完全覆盖的分片 (无需解析)，再把其余分片按块流式读入、
+# 按股票代码区间溢写到磁盘桶中，逐桶按 (code, date) 去重 (后写入者为准) 并写出，内存只需容纳一个桶。
+# 输出的列由分片表头决定：已知的K线列按 KDATA_SCHEMA 定型，其余列原样保留为字符串。
+# 分片的写入顺序取自旁路元数据文件中记录的写出时间 (没有时按路径)，不依赖文件修改时间
+# (artifact 解压后的 mtime 只是解压时间)，因此去重与覆盖判断每次运行都得到同样的结果。
 
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import glob
 import os
+import csv
+import json
+import time
+import shutil
+import hashlib
 from tqdm import tqdm
 import argparse
 
+from kdata_schema import KDATA_SCHEMA, sort_by_code_date, to_typed_table
+from pipeline_metrics import Metrics
+
 # (关键) 输入目录现在是所有 artifacts 被解压的地方
 INPUT_BASE_DIR = "all_data"
 # (关键) 定义一个专门的输出目录
 OUTPUT_DIR = "final_output"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# (新增) 分片元数据缓存 {内容哈希: 元数据}，以及每个输出上一次合并所用的分片哈希 (用于发现输入没有变化)
+SHARD_METADATA_FILE = os.path.join(OUTPUT_DIR, "_shard_metadata.json")
+# (新增) 分片旁的元数据文件 (由写出分片的一方顺带生成)，存在且哈希匹配时连 code/date 列都不用读
+SHARD_META_SUFFIX = ".meta.json"
+# 流式读取 CSV 的块大小 (字节)
+CSV_BLOCK_BYTES = 16 << 20
+# 每个溢写桶大致的行数上限，决定合并阶段的峰值内存
+MERGE_BUCKET_ROWS = 2000000
+SPILL_DIR = os.path.join(OUTPUT_DIR, "_spill")
+
+
+def file_hash(path):
+    """按块计算文件内容的哈希 (只读字节，不解析)"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_header(path):
+    """只读取 CSV 的表头 (列名列表)"""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def open_csv_strings(path, columns=None):
+    """按块流式读取 CSV，所有列都读为字符串 (空字符串保持为 "", 由 to_typed_table 解析为 null)"""
+    header = read_header(path)
+    return pacsv.open_csv(
+        path,
+        read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_BYTES),
+        convert_options=pacsv.ConvertOptions(column_types={name: pa.string() for name in header},
+                                             include_columns=columns),
+    )
+
+
+def shard_metadata(df):
+    """由含 code、date 列的 DataFrame 或 Arrow 表计算分片元数据 {"rows", "codes": {code: [最早日期, 最晚日期, 行数]}}"""
+    if isinstance(df, pd.DataFrame):
+        df = pa.table({'code': df['code'].astype(str), 'date': df['date'].astype(str)})
+    stats = df.select(['code', 'date']).group_by('code').aggregate(
+        [('date', 'min'), ('date', 'max'), ('date', 'count')]).sort_by('code')
+    return {
+        "rows": int(df.num_rows),
+        "codes": {code: [lo, hi, n] for code, lo, hi, n in
+                  zip(*(stats[c].to_pylist() for c in ('code', 'date_min', 'date_max', 'date_count')))},
+    }
+
+
+def output_schema(headers, known=KDATA_SCHEMA):
+    """按各分片表头首次出现的顺序合并列名：known 中的列使用其类型，其余列保留为字符串"""
+    names = list(dict.fromkeys(name for header in headers for name in header))
+    return pa.schema([known.field(name) if name in known.names else pa.field(name, pa.string()) for name in names])
+
+
+def write_shard_metadata(csv_path, df):
+    """
+    (供写出分片的一方调用) 在 CSV 分片旁写出元数据文件，合并时据此免去扫描。
+    written_at 记录写出时间，合并时据此确定分片的先后 (后写入者为准)。
+    """
+    meta = dict(shard_metadata(df), content_hash=file_hash(csv_path), written_at=time.time())
+    with open(csv_path + SHARD_META_SUFFIX, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+
+def read_sidecar(path, digest):
+    """读取分片旁的元数据文件；不存在或内容哈希不匹配 (分片已被改写) 时返回 None"""
+    sidecar = path + SHARD_META_SUFFIX
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    return meta if meta.get("content_hash") == digest else None
+
+
+def shard_order_key(path, sidecar):
+    """分片的写入顺序：按旁路元数据记录的写出时间，没有记录的分片排在最前并按路径排序"""
+    written_at = (sidecar or {}).get("written_at")
+    return (written_at is not None, written_at or 0.0, path)
+
+
+def load_shard_metadata(path, digest, cache, metrics, sidecar=None):
+    """依次尝试: 内容哈希匹配的旁路元数据 -> 按哈希缓存的元数据 -> 只流式读取 code/date 两列计算"""
+    if sidecar is not None:
+        return sidecar
+    if digest in cache:
+        return cache[digest]
+    metrics.incr("shards_scanned")
+    with metrics.stage("scan_metadata"):
+        frames = [shard_metadata(pa.Table.from_batches([batch])) for batch in open_csv_strings(path, ['code', 'date'])]
+    meta = {"rows": sum(m["rows"] for m in frames), "codes": {}}
+    for m in frames:
+        for code, (lo, hi, n) in m["codes"].items():
+            old = meta["codes"].get(code)
+            meta["codes"][code] = [lo, hi, n] if old is None else [min(old[0], lo), max(old[1], hi), old[2] + n]
+    return meta
+
 
-def merge_files(pattern, output_filename):
+def covered_shards(metas):
     """
-    递归搜索、合并数据分片，并进行去重。
+    返回被后写入的分片完全覆盖的分片序号：该分片中的每只股票，都有一个更晚的分片的日期区间包含它的区间。
+    baostock 对同一区间返回的是完整的交易日序列，后写入者又优先，因此这些分片的每一行都会被覆盖。
+    """
+    covered = set()
+    # 从后往前扫描，维护每只股票在更晚分片中出现过的区间
+    later = {}
+    for i in range(len(metas) - 1, -1, -1):
+        codes = metas[i]["codes"]
+        if codes and all(any(lo <= c_lo and hi >= c_hi for lo, hi in later.get(code, ()))
+                         for code, (c_lo, c_hi, _) in codes.items()):
+            covered.add(i)
+        for code, (c_lo, c_hi, _) in codes.items():
+            later.setdefault(code, []).append((c_lo, c_hi))
+    return covered
+
+
+def merge_files(pattern, output_filename, schema=KDATA_SCHEMA):
+    """
+    递归搜索、合并数据分片，按 (code, date) 去重 (后写入的分片为准)，结果按 (code, date) 排序。
+    schema 给出已知列的类型，分片中的其他列以字符串原样保留；缺少 code 或 date 列的分片无法去重，跳过并告警。
+    分片的写入顺序见 shard_order_key。
     """
     # (关键) 使用 recursive=True 深度搜索所有子目录
     search_pattern = os.path.join(INPUT_BASE_DIR, "**", pattern)
-    file_list = glob.glob(search_pattern, recursive=True)
+    file_list = sorted(glob.glob(search_pattern, recursive=True))
 
     if not file_list:
         print(f"⚠️ 未找到任何匹配 '{pattern}' 的文件，无法合并。")
         return
 
     print(f"📦 共找到 {len(file_list)} 个 '{pattern}' 文件，开始合并...")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    metrics = Metrics(f"merge-{os.path.splitext(output_filename)[0]}")
+    output_path = os.path.join(OUTPUT_DIR, output_filename)
+
+    cache = {"shards": {}, "outputs": {}}
+    if os.path.exists(SHARD_METADATA_FILE):
+        with open(SHARD_METADATA_FILE, "r", encoding="utf-8") as f:
+            cache.update(json.load(f))
 
-    all_dfs = []
-    for f in tqdm(file_list, desc=f"正在读取 {pattern} 分片"):
+    # --- 1. 内容哈希：按写入顺序排列，完全相同的分片只保留最后写入的一份 ---
+    hashed = []
+    with metrics.stage("hash"):
+        for f in tqdm(file_list, desc=f"正在计算 {pattern} 分片哈希"):
+            digest = file_hash(f)
+            hashed.append((f, digest, read_sidecar(f, digest)))
+            metrics.incr("bytes_hashed", os.path.getsize(f))
+    hashed.sort(key=lambda item: shard_order_key(item[0], item[2]))
+    shards = {}
+    sidecars = {}
+    for f, digest, sidecar in hashed:
+        shards.pop(digest, None)
+        shards[digest] = f
+        sidecars[digest] = sidecar
+    metrics.incr("shards_identical_skipped", len(file_list) - len(shards))
+    if len(file_list) > len(shards):
+        print(f"ℹ️ 跳过 {len(file_list) - len(shards)} 个内容完全相同的分片。")
+
+    digests = list(shards)
+    previous = cache["outputs"].get(output_filename)
+    if previous and previous.get("shards") == digests and os.path.exists(output_path):
+        print(f"✅ 输入分片与上一次合并完全相同，保留已有的 {output_path}。")
+        return
+
+    # --- 2. 表头与元数据：跳过无法按 (code, date) 去重的分片，以及被后写入分片完全覆盖的分片 ---
+    metas = []
+    headers = []
+    valid = []
+    for digest in digests:
+        path = shards[digest]
         try:
-            df = pd.read_csv(f)
-            all_dfs.append(df)
+            header = read_header(path)
+            missing = [name for name in ('code', 'date') if name not in header]
+            if missing:
+                raise ValueError(f"缺少 {', '.join(missing)} 列，无法按 (code, date) 去重")
+            meta = load_shard_metadata(path, digest, cache["shards"], metrics, sidecars[digest])
         except Exception as e:
-            print(f"\n⚠️ 读取文件 {f} 失败: {e}")
+            metrics.incr("files_failed")
+            print(f"\n⚠️ 读取文件 {path} 失败: {e}")
+            continue
+        cache["shards"][digest] = meta
+        metas.append(meta)
+        headers.append(header)
+        valid.append(digest)
+    if not valid:
+        print("⚠️ 所有文件均读取失败，无法合并。")
+        return
+    digests = valid
+    covered = covered_shards(metas)
+    metrics.incr("shards_covered_skipped", len(covered))
+    if covered:
+        print(f"ℹ️ 跳过 {len(covered)} 个已被后写入分片完全覆盖的分片。")
+    active = [i for i in range(len(digests)) if i not in covered]
+    schema = output_schema([headers[i] for i in active], schema)
 
-    if not all_dfs:
+    # 按股票代码把数据划分为若干连续区间 (桶)，桶内行数不超过 MERGE_BUCKET_ROWS，逐桶处理即可得到全局有序的结果
+    code_rows = {}
+    for i in active:
+        for code, (_, _, n) in metas[i]["codes"].items():
+            code_rows[code] = code_rows.get(code, 0) + n
+    bounds = []
+    rows_in_bucket = 0
+    for code in sorted(code_rows):
+        if rows_in_bucket and rows_in_bucket + code_rows[code] > MERGE_BUCKET_ROWS:
+            bounds.append(code)
+            rows_in_bucket = 0
+        rows_in_bucket += code_rows[code]
+    bounds = np.array(bounds, dtype=object)
+
+    # --- 3. 流式读取需要合并的分片，按桶溢写到磁盘 (只有一个桶时直接留在内存中) ---
+    if os.path.exists(SPILL_DIR):
+        shutil.rmtree(SPILL_DIR)
+    in_memory = len(bounds) == 0
+    memory_pieces = []
+    for seq, i in enumerate(tqdm(active, desc=f"正在读取 {pattern} 分片")):
+        path = shards[digests[i]]
+        try:
+            with metrics.stage("read_csv"):
+                for chunk_no, batch in enumerate(open_csv_strings(path)):
+                    if in_memory:
+                        memory_pieces.append(batch)
+                        continue
+                    buckets = np.searchsorted(bounds, batch.column('code').to_numpy(zero_copy_only=False), side='right')
+                    for bucket in np.unique(buckets):
+                        bucket_dir = os.path.join(SPILL_DIR, f"bucket_{bucket:05d}")
+                        os.makedirs(bucket_dir, exist_ok=True)
+                        part = batch.filter(pa.array(buckets == bucket))
+                        # 文件名按 (分片顺序, 块序号) 排列，桶内按文件名拼接即恢复写入顺序
+                        pq.write_table(pa.Table.from_batches([part]),
+                                       os.path.join(bucket_dir, f"{seq:06d}_{chunk_no:06d}.parquet"))
+            metrics.incr("files_read")
+            metrics.incr("bytes_read", os.path.getsize(path))
+        except Exception as e:
+            metrics.incr("files_failed")
+            print(f"\n⚠️ 读取文件 {path} 失败: {e}")
+
+    bucket_dirs = sorted(glob.glob(os.path.join(SPILL_DIR, "bucket_*")))
+    if not bucket_dirs and not memory_pieces:
         print("⚠️ 所有文件均读取失败，无法合并。")
         return
 
-    print("\n... 所有分片读取完毕，开始合并 ...")
-    merged_df = pd.concat(all_dfs, ignore_index=True)
-    
-    # (关键) 增加去重逻辑，防止因重复运行等原因导致的数据重复
-    initial_rows = len(merged_df)
-    merged_df.drop_duplicates(inplace=True)
-    final_rows = len(merged_df)
-    
-    if initial_rows > final_rows:
-        print(f"ℹ️ 去重操作移除了 {initial_rows - final_rows} 条重复记录。")
-
-    if 'code' in merged_df.columns and 'date' in merged_df.columns:
-        merged_df.sort_values(by=['code', 'date'], inplace=True)
-
-    # (关键) 保存为 Parquet 格式
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
-    merged_df.to_parquet(output_path, index=False, compression='zstd')
+    def bucket_tables():
+        """按代码区间顺序逐个返回每个桶的 (全字符串) 表，桶内保持写入顺序"""
+        if in_memory:
+            yield pa.concat_tables([pa.Table.from_batches([b]) for b in memory_pieces], promote_options="default")
+            return
+        for bucket_dir in bucket_dirs:
+            pieces = sorted(glob.glob(os.path.join(bucket_dir, "*.parquet")))
+            yield pa.concat_tables([pq.read_table(p) for p in pieces], promote_options="default")
+
+    # --- 4. 逐桶按 (code, date) 去重 (后写入者为准) 并写出 ---
+    print("\n... 所有分片读取完毕，开始逐桶去重合并 ...")
+    tmp_path = output_path + ".tmp"
+    writer = None
+    total_rows = 0
+    duplicates = 0
+    codes = set()
+    try:
+        tables = bucket_tables()
+        for _ in tqdm(range(max(len(bucket_dirs), 1)), desc="正在合并"):
+            with metrics.stage("concat"):
+                strings = next(tables)
+            with metrics.stage("drop_duplicates"):
+                # 每个 (code, date) 只保留行号最大 (即最后写入) 的一行
+                strings = strings.append_column('_row', pa.array(np.arange(strings.num_rows)))
+                keep = strings.group_by(['code', 'date'], use_threads=False).aggregate([('_row', 'max')])
+                deduped = strings.take(keep['_row_max']).drop_columns(['_row'])
+            duplicates += strings.num_rows - deduped.num_rows
+            with metrics.stage("sort"):
+                table = sort_by_code_date(to_typed_table({name: deduped[name] for name in deduped.column_names}, schema))
+            with metrics.stage("write_parquet"):
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, table.schema, compression='zstd')
+                writer.write_table(table)
+            total_rows += table.num_rows
+            codes.update(pc.unique(deduped['code']).to_pylist())
+    finally:
+        if writer is not None:
+            writer.close()
+        shutil.rmtree(SPILL_DIR, ignore_errors=True)
+    os.replace(tmp_path, output_path)
+
+    metrics.incr("duplicates_removed", duplicates)
+    if duplicates:
+        print(f"ℹ️ 去重操作移除了 {duplicates} 条 (code, date) 重复记录。")
+    metrics.incr("rows", total_rows)
+    metrics.incr("bytes_written", os.path.getsize(output_path))
+
+    # 有分片读取失败时不记录本次的输入，下一次运行会重新合并
+    if not metrics.counters.get("files_failed"):
+        cache["outputs"][output_filename] = {"shards": digests, "rows": total_rows}
+    referenced = {d for output in cache["outputs"].values() for d in output["shards"]} | set(digests)
+    cache["shards"] = {d: meta for d, meta in cache["shards"].items() if d in referenced}
+    with open(SHARD_METADATA_FILE, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False)
 
     print(f"\n✅ 合并完成！已保存为 Parquet 文件: {output_path}")
-    print(f"   - 总计记录数: {len(merged_df)}")
-    if 'code' in merged_df.columns:
-        print(f"   - 涉及股票数: {merged_df['code'].nunique()}")
+    print(f"   - 总计记录数: {total_rows}")
+    print(f"   - 涉及股票数: {len(codes)}")
+    metrics.write(os.path.join(OUTPUT_DIR, f"_metrics_{metrics.job}.json"))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="合并数据分片并保存为 Parquet 文件。")
     parser.add_argument('--output', type=str, required=True, help="输出的 Parquet 文件名")
     args = parser.parse_args()
-    
+
     # 我们现在只合并日线数据
     merge_files("*_kdata.csv", args.output)
-    
+
     # 如果未来有资金流数据，可以取消这行注释
     # merge_files("*_moneyflow.csv", "full_moneyflow.parquet")
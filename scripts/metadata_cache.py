@@ -0,0 +1,86 @@
+# scripts/metadata_cache.py
+# 持久化的元数据缓存 (metadata_cache.json)：上市股票集合 (名称、上市日期、首次出现日期) 与最近交易日。
+# 每只股票已存储数据的最后交易日不在这里重复保存，而是以各目标的高水位清单 (kdata*/_manifest.json) 为准，
+# 由 prepare_tasks.load_last_updated 读取。交易日历沿用 quality_check 的 trade_calendar.json 缓存。
+# prepare_tasks 据此把当天的股票全集与上一次对比，只调度新上市、数据落后或需要全量刷新的股票。
+
+import os
+import json
+from datetime import datetime
+
+import numpy as np
+
+METADATA_CACHE_FILE = "metadata_cache.json"
+# 每只股票的调度类别
+NEW = "new"                    # 上一次的上市集合中没有 (新上市，或首次运行)
+MISSING = "missing"            # 以前就在上市集合中，但本地没有任何已存储的数据
+STALE = "stale"                # 已存储数据的最后交易日早于最近交易日，只需增量下载
+FULL_REFRESH = "full_refresh"  # 强制全量刷新，或上市日期变化 (代码被复用)
+UP_TO_DATE = "up_to_date"      # 已是最新，无需下载
+SCHEDULED_CATEGORIES = (NEW, MISSING, STALE, FULL_REFRESH)
+
+
+def load_metadata_cache(path=METADATA_CACHE_FILE):
+    """读取元数据缓存，不存在时返回空缓存"""
+    cache = {"listing": {}, "latest_trade_day": None}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            cache.update(json.load(f))
+    # 旧版本缓存中的 last_updated 从未被读取，新鲜度以高水位清单为准
+    cache.pop("last_updated", None)
+    return cache
+
+
+def save_metadata_cache(cache, path=METADATA_CACHE_FILE):
+    cache["updated_at"] = datetime.now().isoformat(timespec="seconds")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False)
+    print(f"  -> 🗂️ 元数据缓存已保存到 {path} ({len(cache['listing'])} 支上市股票)")
+
+
+def recent_trade_days(calendar, today, count=3):
+    """返回交易日历中严格早于 today 的最近 count 个交易日 ('YYYY-MM-DD'，由近到远)"""
+    end = np.searchsorted(calendar, np.datetime64(today, "D"), side="left")
+    return [str(d) for d in calendar[max(0, end - count):end][::-1]]
+
+
+def diff_universe(stock_list, cache, last_updated, latest_day, list_dates=None, force_full=False):
+    """
+    把当天的股票全集与缓存对比，返回 {类别: [股票]} 以及已退市 (不在当天全集中) 的代码列表。
+    last_updated 为 {code: 已存储数据的最后交易日}；list_dates 为 {code: 上市日期}，用于发现被复用的代码。
+    """
+    listing = cache.get("listing", {})
+    list_dates = list_dates or {}
+    groups = {category: [] for category in SCHEDULED_CATEGORIES + (UP_TO_DATE,)}
+    for s in stock_list:
+        code = s["code"]
+        previous = listing.get(code)
+        ipo_changed = (previous is not None and previous.get("ipoDate") and list_dates.get(code)
+                       and previous["ipoDate"] != list_dates[code])
+        if previous is None:
+            category = NEW
+        elif force_full or ipo_changed:
+            category = FULL_REFRESH
+        elif not last_updated.get(code):
+            category = MISSING
+        elif last_updated[code] < latest_day:
+            category = STALE
+        else:
+            category = UP_TO_DATE
+        groups[category].append(s)
+    current = {s["code"] for s in stock_list}
+    delisted = sorted(code for code in listing if code not in current)
+    return groups, delisted
+
+
+def update_listing(cache, stock_list, list_dates, today):
+    """用当天的全集刷新缓存中的上市集合，保留每只股票首次出现的日期"""
+    previous = cache.get("listing", {})
+    cache["listing"] = {
+        s["code"]: {
+            "name": s["name"],
+            "ipoDate": (list_dates or {}).get(s["code"]) or previous.get(s["code"], {}).get("ipoDate"),
+            "first_seen": previous.get(s["code"], {}).get("first_seen", today),
+        }
+        for s in stock_list
+    }
@@ -0,0 +1,126 @@
+# scripts/pipeline_metrics.py
+# 流水线计时与吞吐量指标：分阶段计时、计数器、瞬时值、延迟直方图，
+# 每个 job 输出一个机器可读的 JSON 文件，collect 阶段再汇总成一份运行级报告。
+
+import os
+import json
+import glob
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# 延迟直方图的桶上界 (秒)，最后一个桶收纳所有更大的值
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60]
+
+
+class Metrics:
+    """单个 job (或单个工作进程) 的指标容器，可通过 merge() 合并其他容器的 to_dict() 结果"""
+
+    def __init__(self, job):
+        self.job = job
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self._t0 = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        # 瞬时值 (如最终的限流速率)，只属于单个 job，merge() 时不累加
+        self.gauges = {}
+        self.histograms = {}
+
+    @contextmanager
+    def stage(self, name):
+        """计时一个阶段: with metrics.stage("query"): ..."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def add_time(self, name, seconds, count=1):
+        s = self.stages.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+        s["count"] += count
+        s["seconds"] += seconds
+        s["max_seconds"] = max(s["max_seconds"], seconds)
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        """把一个观测值 (如单只股票的下载耗时) 计入直方图"""
+        h = self.histograms.setdefault(name, {"buckets": LATENCY_BUCKETS, "counts": [0] * (len(LATENCY_BUCKETS) + 1),
+                                              "count": 0, "sum": 0.0})
+        i = next((k for k, bound in enumerate(h["buckets"]) if value <= bound), len(h["buckets"]))
+        h["counts"][i] += 1
+        h["count"] += 1
+        h["sum"] += value
+
+    def merge(self, other):
+        """合并另一个 Metrics.to_dict() 的结果 (如工作进程回传的指标)；瞬时值不跨 job 合并"""
+        for name, s in other.get("stages", {}).items():
+            mine = self.stages.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            mine["count"] += s["count"]
+            mine["seconds"] += s["seconds"]
+            mine["max_seconds"] = max(mine["max_seconds"], s["max_seconds"])
+        for name, value in other.get("counters", {}).items():
+            self.incr(name, value)
+        for name, h in other.get("histograms", {}).items():
+            mine = self.histograms.setdefault(name, {"buckets": h["buckets"], "counts": [0] * len(h["counts"]),
+                                                     "count": 0, "sum": 0.0})
+            mine["counts"] = [a + b for a, b in zip(mine["counts"], h["counts"])]
+            mine["count"] += h["count"]
+            mine["sum"] += h["sum"]
+
+    def to_dict(self):
+        wall = time.perf_counter() - self._t0
+        derived = {}
+        if wall > 0 and "rows" in self.counters:
+            derived["rows_per_second"] = round(self.counters["rows"] / wall, 1)
+        if wall > 0 and "bytes_written" in self.counters:
+            derived["mb_written_per_second"] = round(self.counters["bytes_written"] / wall / 1e6, 3)
+        return {
+            "job": self.job,
+            "started_at": self.started_at,
+            "wall_seconds": round(wall, 3),
+            "stages": {k: {**v, "seconds": round(v["seconds"], 3), "max_seconds": round(v["max_seconds"], 3)}
+                       for k, v in self.stages.items()},
+            "counters": self.counters,
+            "gauges": self.gauges,
+            "histograms": self.histograms,
+            "derived": derived,
+        }
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        print(f"📊 指标已保存到: {path}")
+
+
+def aggregate_reports(pattern, extra=None):
+    """
+    汇总所有匹配 pattern 的 job 指标文件 (以及可选的 extra 字典) 为一份运行级报告：
+    各 job 原始指标 + 合并后的总计 + 最慢 job。
+    """
+    jobs = []
+    for path in sorted(glob.glob(pattern, recursive=True)):
+        with open(path, "r", encoding="utf-8") as f:
+            jobs.append(json.load(f))
+    if extra is not None:
+        jobs.append(extra)
+
+    totals = Metrics("run-total")
+    for job in jobs:
+        totals.merge(job)
+    total_dict = totals.to_dict()
+    del total_dict["wall_seconds"], total_dict["started_at"], total_dict["derived"], total_dict["gauges"]
+
+    slowest = max(jobs, key=lambda j: j.get("wall_seconds", 0), default=None)
+    return {
+        "job_count": len(jobs),
+        "slowest_job": None if slowest is None else {"job": slowest["job"], "wall_seconds": slowest["wall_seconds"]},
+        "job_wall_seconds": {j["job"]: j.get("wall_seconds") for j in jobs},
+        "totals": total_dict,
+        "jobs": jobs,
+    }
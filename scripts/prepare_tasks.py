@@ -1,47 +1,155 @@
 # scripts/prepare_tasks.py (测试版)
 
-import baostock as bs
 import pandas as pd
+import numpy as np
 import json
-import random
+import heapq
 import os
+import importlib
 from datetime import datetime, timedelta
 
+from kdata_schema import BARS_PER_DAY, needs_full_history, parse_targets, target_suffix
+from metadata_cache import (SCHEDULED_CATEGORIES, FULL_REFRESH, diff_universe, load_metadata_cache,
+                            recent_trade_days, save_metadata_cache, update_listing)
+from quality_check import load_trade_calendar
+
+# 与下载脚本一致，可通过 BAOSTOCK_MODULE 注入替身模块
+bs = importlib.import_module(os.getenv("BAOSTOCK_MODULE", "baostock"))
+
 # --- 配置 ---
 TASK_COUNT = 20
 OUTPUT_DIR = "task_slices"
 # (新增) 测试时只处理的股票数量
 TEST_STOCK_LIMIT = 100 
+# (新增) 上一次 collect 阶段写出的每只股票行数，用于估计下载成本
+ROW_COUNTS_FILE = "stock_row_counts.json"
+# 预测的每个分片成本，供事后核对最慢分片是否真的变短
+COST_REPORT_FILE = os.path.join(OUTPUT_DIR, "task_costs.json")
+# 与下载脚本保持一致的起始日期，用于按上市日期估算行数
+START_DATE = "2005-01-01"
+# 每只股票固定的请求开销 (折算成行数)，避免短历史股票被视为零成本
+PER_CODE_OVERHEAD_ROWS = 250
+# (新增) 与下载脚本一致的目标列表，每只股票的成本为各目标成本之和
+TARGETS = parse_targets(os.getenv("KDATA_TARGETS", "d:3"))
+# (新增) 增量模式下只调度有变化的股票 (新上市 / 没有本地数据 / 数据落后 / 需要全量刷新)
+INCREMENTAL = os.getenv("INCREMENTAL", "0") == "1"
+# (新增) FULL_REFRESH=1 时增量模式下也让所有已上市股票重新全量下载
+FORCE_FULL_REFRESH = os.getenv("FULL_REFRESH", "0") == "1"
+# 下载脚本/collect 阶段写出的高水位清单 (每个目标一个)
+HISTORY_DIR = "kdata"
+MANIFEST_NAME = "_manifest.json"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-def get_recent_trade_day():
-    # ... (此函数保持不变)
-    for i in range(1, 7):
-        day = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-        rs = bs.query_trade_dates(start_date=day, end_date=day)
-        if rs.error_code == '0' and rs.next() and rs.get_row_data()[1] == '1':
-            print(f"📅 自动获取到最近交易日: {day}")
-            return day
-    raise Exception("一周内未找到有效交易日。")
+def get_stock_universe(trade_days):
+    """
+    按交易日历从近到远尝试 query_all_stock (最近一个交易日的数据可能尚未发布)，
+    返回筛选后的 [{'code', 'name'}] 和实际使用的交易日。
+    """
+    for day in trade_days:
+        rs = bs.query_all_stock(day=day)
+        if rs.error_code != '0':
+            print(f"  -> ⚠️ 获取 {day} 的股票列表失败: {rs.error_msg}")
+            continue
+        stock_df = rs.get_data()
+        if stock_df.empty:
+            continue
+        codes = stock_df['code'].astype(str)
+        names = stock_df['code_name'].astype(str)
+        mask = codes.str.startswith(('sh.', 'sz.', 'bj.')) & ~names.str.contains('ST|退')
+        stock_list = [{'code': c, 'name': n} for c, n in zip(codes[mask], names[mask])]
+        print(f"📅 最近交易日: {day}")
+        return stock_list, day
+    raise Exception(f"最近的交易日 {trade_days} 均未获取到股票列表。")
+
+def load_last_updated(targets=TARGETS):
+    """
+    读取各目标的高水位清单，返回 {code: 最后交易日}。
+    多个目标时取最早的日期；任一目标中缺失的股票视为没有本地数据。
+    """
+    manifests = []
+    for target in targets:
+        path = os.path.join(HISTORY_DIR + target_suffix(target), MANIFEST_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            manifests.append(json.load(f))
+    codes = set.intersection(*(set(m) for m in manifests)) if manifests else set()
+    return {code: min(m[code] for m in manifests) for code in codes}
+
+def load_row_counts():
+    """读取上一次运行的每只股票行数 {code: rows}，不存在时返回空字典"""
+    if not os.path.exists(ROW_COUNTS_FILE):
+        return {}
+    with open(ROW_COUNTS_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def get_list_dates():
+    """通过 query_stock_basic 一次性获取所有股票的上市日期 {code: ipoDate}"""
+    rs = bs.query_stock_basic()
+    if rs.error_code != '0':
+        print(f"  -> ⚠️ 获取上市日期失败: {rs.error_msg}")
+        return {}
+    basic_df = rs.get_data()
+    return dict(zip(basic_df['code'], basic_df['ipoDate']))
+
+def estimate_costs(stock_list, row_counts, list_dates, targets=TARGETS, last_updated=None):
+    """
+    估计每只股票的下载成本 (以K线行数计)。
+    先估计日线行数：增量下载的股票按最后已存储交易日到今天的工作日数估算；
+    否则优先使用上一次运行的实际行数；没有则按上市日期到今天的工作日数估算；
+    都没有时按从 START_DATE 起的完整历史估算。再按各目标每日的K线条数 (BARS_PER_DAY)
+    折算并加上每个目标一次请求的固定开销。前复权目标每次都整段下载，始终按完整历史估算。
+    """
+    today = datetime.now().date()
+    full_history_rows = int(np.busday_count(pd.Timestamp(START_DATE).date(), today))
+    last_updated = last_updated or {}
+    costs = {}
+    for s in stock_list:
+        code = s['code']
+        if code in row_counts:
+            history_rows = int(row_counts[code])
+        elif list_dates.get(code):
+            start = max(pd.Timestamp(list_dates[code]), pd.Timestamp(START_DATE))
+            history_rows = int(np.busday_count(start.date(), today))
+        else:
+            history_rows = full_history_rows
+        rows = history_rows
+        if code in last_updated and not s.get('full_refresh'):
+            rows = int(np.busday_count((pd.Timestamp(last_updated[code]) + timedelta(days=1)).date(), today))
+        costs[code] = sum(int((history_rows if needs_full_history(target) else rows) * BARS_PER_DAY[target[0]])
+                          + PER_CODE_OVERHEAD_ROWS for target in targets)
+    return costs
+
+def partition_by_cost(stock_list, costs, task_count):
+    """
+    最长处理时间优先 (LPT) 贪心装箱：按成本从大到小，依次放入当前总成本最小的分片。
+    返回 (分片列表, 每个分片的预测成本)。
+    """
+    slices = [[] for _ in range(task_count)]
+    slice_costs = [0] * task_count
+    heap = [(0, i) for i in range(task_count)]
+    for s in sorted(stock_list, key=lambda s: (-costs[s['code']], s['code'])):
+        load, i = heapq.heappop(heap)
+        slices[i].append(s)
+        slice_costs[i] = load + costs[s['code']]
+        heapq.heappush(heap, (slice_costs[i], i))
+    return slices, slice_costs
 
 def main():
     print("🚀 开始从 Baostock 准备并行下载任务...")
-    
+
+    # 交易日历来自本地缓存，只有缓存没覆盖到的尾部才查询 baostock (自行登录/登出)
+    today = datetime.now().strftime('%Y-%m-%d')
+    calendar, calendar_source = load_trade_calendar(end_date=today)
+    print(f"📅 交易日历来源: {calendar_source}")
+
     lg = bs.login()
     if lg.error_code != '0':
         raise Exception(f"登录失败：{lg.error_msg}")
     print("✅ 登录成功")
 
     try:
-        # ... (获取股票列表的逻辑保持不变)
-        trade_day = get_recent_trade_day()
-        rs_stock = bs.query_all_stock(day=trade_day)
-        stock_df = rs_stock.get_data()
-        stock_list = []
-        for index, row in stock_df.iterrows():
-            code, name = row['code'], row['code_name']
-            if str(code).startswith(('sh.', 'sz.', 'bj.')) and 'ST' not in name and '退' not in name:
-                stock_list.append({'code': code, 'name': name})
+        stock_list, trade_day = get_stock_universe(recent_trade_days(calendar, today))
         print(f"  -> 成功获取并筛选出 {len(stock_list)} 支股票。")
 
         # --- (这是唯一的、关键的修正) ---
@@ -49,19 +157,64 @@ def main():
         stock_list = stock_list[:TEST_STOCK_LIMIT]
         # ------------------------------------
 
-        random.shuffle(stock_list)
-        print("  -> 🃏 已将股票列表随机打乱。")
+        cache = load_metadata_cache()
+        row_counts = load_row_counts()
+        print(f"  -> 📏 已加载 {len(row_counts)} 条上一次运行的行数记录。")
+        list_dates = {}
+        if INCREMENTAL or any(s['code'] not in row_counts for s in stock_list):
+            list_dates = get_list_dates()
+
+        # --- 与上一次的上市集合对比，只调度需要下载的股票 ---
+        last_updated = load_last_updated()
+        scheduled = stock_list
+        schedule_summary = {}
+        if INCREMENTAL:
+            groups, delisted = diff_universe(stock_list, cache, last_updated, trade_day, list_dates, FORCE_FULL_REFRESH)
+            for s in groups[FULL_REFRESH]:
+                s['full_refresh'] = True
+            scheduled = [s for category in SCHEDULED_CATEGORIES for s in groups[category]]
+            schedule_summary = {category: len(items) for category, items in groups.items()}
+            schedule_summary['delisted'] = len(delisted)
+            print("  -> 🔍 对比元数据缓存: " + "，".join(f"{k} {v}" for k, v in schedule_summary.items()))
+            print(f"  -> 📋 本次只调度 {len(scheduled)} / {len(stock_list)} 支股票。")
+
+        costs = estimate_costs(scheduled, row_counts, list_dates, last_updated=last_updated if INCREMENTAL else None)
+
+        slices, slice_costs = partition_by_cost(scheduled, costs, TASK_COUNT)
+        print("  -> ⚖️ 已按预测成本 (LPT 贪心装箱) 分配任务。")
 
-        chunk_size = (len(stock_list) + TASK_COUNT - 1) // TASK_COUNT
-        print(f"  -> 每个任务分片包含约 {chunk_size} 支股票。")
-        
-        for i in range(TASK_COUNT):
-            subset = stock_list[i * chunk_size : (i + 1) * chunk_size]
+        for i, subset in enumerate(slices):
             slice_filepath = os.path.join(OUTPUT_DIR, f"task_slice_{i}.json")
             with open(slice_filepath, "w", encoding="utf-8") as f:
                 json.dump(subset, f, ensure_ascii=False)
-                
-        print(f"\n✅ 成功生成 {TASK_COUNT} 个随机任务分片。")
+
+        mean_cost = sum(slice_costs) / TASK_COUNT
+        cost_report = {
+            'cost_unit': 'rows',
+            'targets': [f"{frequency}:{adjustflag}" for frequency, adjustflag in TARGETS],
+            'per_code_overhead_rows': PER_CODE_OVERHEAD_ROWS,
+            'universe_stocks': len(stock_list),
+            'scheduled_stocks': len(scheduled),
+            'schedule': schedule_summary,
+            'codes_with_row_counts': sum(1 for s in scheduled if s['code'] in row_counts),
+            'max_slice_cost': max(slice_costs),
+            'mean_slice_cost': round(mean_cost, 1),
+            'imbalance_ratio': round(max(slice_costs) / mean_cost, 3) if mean_cost else None,
+            'slices': [
+                {'index': i, 'stocks': len(subset), 'predicted_cost': slice_costs[i]}
+                for i, subset in enumerate(slices)
+            ],
+        }
+        with open(COST_REPORT_FILE, "w", encoding="utf-8") as f:
+            json.dump(cost_report, f, ensure_ascii=False, indent=2)
+        print(f"  -> 📄 预测成本已保存到 {COST_REPORT_FILE} (最大/平均 = {cost_report['imbalance_ratio']})")
+
+        # --- 刷新元数据缓存 ---
+        update_listing(cache, stock_list, list_dates, today)
+        cache['latest_trade_day'] = trade_day
+        save_metadata_cache(cache)
+
+        print(f"\n✅ 成功生成 {TASK_COUNT} 个按成本均衡的任务分片。")
 
     finally:
         bs.logout()
@@ -0,0 +1,264 @@
+# scripts/quality_check.py
+# 全市场数据质量检查：按批 (可流式喂入) 对每只股票做一次向量化检查，
+# 对照交易所真实交易日历 (bs.query_trade_dates，本地缓存) 统计缺失交易日、
+# 前收盘价连续性与涨跌幅一致性，并给出每只股票的缺口列表。
+
+import os
+import json
+import importlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# --- 配置 ---
+# 交易日历的本地缓存文件
+TRADE_CALENDAR_FILE = "trade_calendar.json"
+# 日历起始日期，与下载脚本的 START_DATE 一致
+CALENDAR_START_DATE = "2005-01-01"
+# 攒够多少行做一次向量化检查 (控制流式模式下的内存)
+QC_BATCH_ROWS = 500000
+# 前收盘价与上一交易日收盘价的允许误差 (元)
+PRECLOSE_TOLERANCE = 0.011
+# 涨跌幅与 (close / preclose - 1) * 100 的允许误差 (百分点)
+PCTCHG_TOLERANCE = 0.01
+# 每只股票最多列出的缺口区间数
+MAX_GAPS_PER_CODE = 20
+
+
+def _query_trading_days(start_date, end_date):
+    """调用 bs.query_trade_dates 一次性获取一段区间内的全部交易日 ('YYYY-MM-DD' 列表)"""
+    bs = importlib.import_module(os.getenv("BAOSTOCK_MODULE", "baostock"))
+    lg = bs.login()
+    if lg.error_code != '0':
+        raise Exception(f"登录失败: {lg.error_msg}")
+    try:
+        rs = bs.query_trade_dates(start_date=start_date, end_date=end_date)
+        if rs.error_code != '0':
+            raise Exception(rs.error_msg)
+        cal_df = rs.get_data()
+    finally:
+        bs.logout()
+    return cal_df.loc[cal_df['is_trading_day'] == '1', 'calendar_date'].tolist()
+
+
+def load_trade_calendar(start_date=CALENDAR_START_DATE, end_date=None):
+    """
+    返回 (交易日数组 datetime64[D], 来源说明)。
+    优先使用本地缓存，缓存没覆盖到的尾部区间才调用 bs.query_trade_dates 补齐并写回缓存；
+    baostock 不可用时，缺失部分退回到工作日日历 (不含节假日信息)。
+    """
+    end_date = end_date or datetime.now().strftime("%Y-%m-%d")
+    cached_days = []
+    fetch_start = start_date
+    if os.path.exists(TRADE_CALENDAR_FILE):
+        with open(TRADE_CALENDAR_FILE, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached["start_date"] <= start_date:
+            if cached["end_date"] >= end_date:
+                return np.array(cached["trading_days"], dtype="datetime64[D]"), "cache"
+            cached_days = cached["trading_days"]
+            fetch_start = (pd.Timestamp(cached["end_date"]) + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+
+    try:
+        trading_days = cached_days + _query_trading_days(fetch_start, end_date)
+        with open(TRADE_CALENDAR_FILE, "w", encoding="utf-8") as f:
+            json.dump({"start_date": start_date, "end_date": end_date, "trading_days": trading_days}, f)
+        return np.array(trading_days, dtype="datetime64[D]"), "baostock"
+    except Exception as e:
+        print(f"  -> ⚠️ [QC] 无法获取交易日历 ({e})，缺失部分退回到工作日日历。")
+        business_days = pd.bdate_range(fetch_start, end_date).strftime("%Y-%m-%d").tolist()
+        source = "cache+business_days" if cached_days else "business_days"
+        return np.array(cached_days + business_days, dtype="datetime64[D]"), source
+
+
+def _gap_ranges(positions, days):
+    """把缺失的交易日 (positions 为其在日历中的位置) 压缩成 [起, 止] 区间列表，相邻交易日视为同一个缺口"""
+    if len(positions) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts = np.r_[0, breaks]
+    ends = np.r_[breaks, len(positions)] - 1
+    return [[str(days[s]), str(days[e])] for s, e in zip(starts, ends)]
+
+
+def check_batch(df, calendar):
+    """
+    对一批数据 (可含多只股票) 做一次向量化检查，返回每只股票一行的统计 DataFrame 和各列空值数。
+    不使用 groupby.apply，所有指标都基于按 (code, date) 排序后的数组和 bincount 计算。
+    """
+    df = df.sort_values(['code', 'date'], kind='stable')
+    codes = df['code'].astype(str).to_numpy()
+    dates = pd.to_datetime(df['date'], errors='coerce').to_numpy().astype("datetime64[D]")
+    n = len(df)
+
+    new_code = np.r_[True, codes[1:] != codes[:-1]]
+    group_id = np.cumsum(new_code) - 1
+    starts = np.flatnonzero(new_code)
+    ends = np.r_[starts[1:], n]
+    n_groups = len(starts)
+
+    def per_code(mask):
+        return np.bincount(group_id, weights=mask.astype(np.float64), minlength=n_groups).astype(np.int64)
+
+    def col(name):
+        if name in df.columns:
+            return pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        return np.full(n, np.nan)
+
+    # --- 完整性：对照交易日历 ---
+    duplicate = np.r_[False, (codes[1:] == codes[:-1]) & (dates[1:] == dates[:-1])]
+    in_calendar = np.isin(dates, calendar)
+    first = dates[starts]
+    last = dates[ends - 1]
+    cal_lo = np.searchsorted(calendar, first, side="left")
+    cal_hi = np.searchsorted(calendar, last, side="right")
+    expected = cal_hi - cal_lo
+    present = per_code(in_calendar & ~duplicate)
+    missing = np.maximum(expected - present, 0)
+
+    # --- 连续性：前收盘价应等于上一交易日收盘价 (除权除息日除外) ---
+    open_, high, low, close, preclose = col('open'), col('high'), col('low'), col('close'), col('preclose')
+    volume, pct_chg = col('volume'), col('pctChg')
+    prev_close = np.r_[np.nan, close[:-1]]
+    prev_close[new_code] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        preclose_break = np.abs(preclose - prev_close) > PRECLOSE_TOLERANCE
+        pct_expected = (close / preclose - 1) * 100
+        pct_mismatch = np.abs(pct_expected - pct_chg) > PCTCHG_TOLERANCE
+
+        negative = (open_ < 0) | (high < 0) | (low < 0) | (close < 0)
+        zero = (close <= 0) | (volume <= 0)
+        high_low = high < low
+
+    stats = pd.DataFrame({
+        'code': codes[starts],
+        'rows': ends - starts,
+        'first_date': first,
+        'last_date': last,
+        'expected_trading_days': expected,
+        'missing_trading_days': missing,
+        'off_calendar_rows': per_code(~in_calendar),
+        'duplicate_rows': per_code(duplicate),
+        'preclose_breaks': per_code(preclose_break),
+        'pctchg_mismatches': per_code(pct_mismatch),
+        'negative_prices': per_code(negative),
+        'zero_prices_or_volume': per_code(zero),
+        'high_lower_than_low': per_code(high_low),
+    })
+
+    # 只对确实有缺口的股票求具体缺失日期
+    gaps = [[] for _ in range(n_groups)]
+    for g in np.flatnonzero(missing > 0):
+        window = calendar[cal_lo[g]:cal_hi[g]]
+        positions = np.flatnonzero(~np.isin(window, dates[starts[g]:ends[g]]))
+        gaps[g] = _gap_ranges(positions, window[positions])
+    stats['gaps'] = gaps
+
+    null_counts = df.isnull().sum()
+    return stats, null_counts
+
+
+class QualityChecker:
+    """
+    可流式使用的质检累加器：按股票顺序 update() 传入 DataFrame 或 Arrow 表，
+    攒够 QC_BATCH_ROWS 行后做一次向量化检查，只保留每只股票的汇总统计。
+    同一只股票的数据必须在同一次 update() 中传入。
+    """
+
+    def __init__(self, calendar=None, calendar_source=None):
+        if calendar is None:
+            calendar, calendar_source = load_trade_calendar()
+        self.calendar = calendar
+        self.calendar_source = calendar_source
+        self._pending = []
+        self._pending_rows = 0
+        self._stats = []
+        self._null_counts = None
+
+    def update(self, data):
+        if isinstance(data, pa.Table):
+            data = data.to_pandas(date_as_object=False)
+        if data.empty:
+            return
+        self._pending.append(data)
+        self._pending_rows += len(data)
+        if self._pending_rows >= QC_BATCH_ROWS:
+            self._flush()
+
+    def add_checked(self, stats, null_counts):
+        """并入在别处 (如工作进程中) 已由 check_batch 算好的一批结果"""
+        self._stats.append(stats)
+        self._null_counts = null_counts if self._null_counts is None else self._null_counts.add(null_counts, fill_value=0)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        batch = pd.concat(self._pending, ignore_index=True)
+        self._pending = []
+        self._pending_rows = 0
+        self.add_checked(*check_batch(batch, self.calendar))
+
+    def per_code_stats(self):
+        """返回每只股票一行的完整统计 (会先处理尚未检查的缓冲数据)"""
+        self._flush()
+        if not self._stats:
+            return pd.DataFrame()
+        return pd.concat(self._stats, ignore_index=True)
+
+    def report(self):
+        """汇总成与 data_quality_report.json 对应的报告字典"""
+        stats = self.per_code_stats()
+        if stats.empty:
+            return {}
+        stock_lengths = stats.set_index('code')['rows']
+        null_counts = self._null_counts
+
+        issue_cols = ['missing_trading_days', 'off_calendar_rows', 'duplicate_rows', 'preclose_breaks',
+                      'pctchg_mismatches', 'negative_prices', 'zero_prices_or_volume', 'high_lower_than_low']
+        with_issues = stats[(stats[issue_cols] > 0).any(axis=1)]
+        per_code_issues = {
+            row.code: {
+                **{c: int(getattr(row, c)) for c in issue_cols if getattr(row, c) > 0},
+                'gaps': row.gaps[:MAX_GAPS_PER_CODE],
+                'gap_count': len(row.gaps),
+            }
+            for row in with_issues.itertuples(index=False)
+        }
+
+        return {
+            'total_records': int(stats['rows'].sum()),
+            'total_stocks': int(len(stats)),
+            'start_date': pd.Timestamp(stats['first_date'].min()).strftime('%Y-%m-%d'),
+            'end_date': pd.Timestamp(stats['last_date'].max()).strftime('%Y-%m-%d'),
+            'completeness_check': {
+                'calendar_source': self.calendar_source,
+                'stocks_checked': int(len(stats)),
+                'stocks_with_missing_days': int((stats['missing_trading_days'] > 0).sum()),
+                'total_missing_trading_days': int(stats['missing_trading_days'].sum()),
+                'off_calendar_rows': int(stats['off_calendar_rows'].sum()),
+                'duplicate_rows': int(stats['duplicate_rows'].sum()),
+            },
+            'accuracy_checks': {
+                'negative_prices': int(stats['negative_prices'].sum()),
+                'zero_prices_or_volume': int(stats['zero_prices_or_volume'].sum()),
+                'high_lower_than_low': int(stats['high_lower_than_low'].sum()),
+            },
+            'continuity_checks': {
+                # 不复权数据在除权除息日前收盘价本来就会与上一日收盘价不同
+                'preclose_breaks': int(stats['preclose_breaks'].sum()),
+                'stocks_with_preclose_breaks': int((stats['preclose_breaks'] > 0).sum()),
+                'pctchg_mismatches': int(stats['pctchg_mismatches'].sum()),
+            },
+            'nan_values_summary': null_counts[null_counts > 0].astype(int).to_dict(),
+            'distribution_stats': {
+                'avg_records_per_stock': round(float(stock_lengths.mean()), 2),
+                'median_records_per_stock': int(stock_lengths.median()),
+                'stocks_over_15_years': int((stock_lengths > 250*15).sum()),
+                'stocks_over_10_years': int((stock_lengths > 250*10).sum()),
+                'stocks_over_5_years': int((stock_lengths > 250*5).sum()),
+                'stocks_under_1_year': int((stock_lengths < 250*1).sum())
+            },
+            'per_code_issues': per_code_issues,
+        }
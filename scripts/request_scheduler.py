@@ -0,0 +1,188 @@
+# scripts/request_scheduler.py
+# baostock 请求调度器：分区内所有下载进程共享一个令牌桶 (限制请求速率) 和一个在途请求上限，
+# 两者都按 AIMD 自适应调整 —— 请求成功时缓慢加性增加，遇到限流/网络错误或延迟超标时乘性减半。
+# 失败的请求按错误类型分类重试 (带抖动的指数退避)，会话失效时先重新登录再重试。
+
+import os
+import time
+import random
+import multiprocessing
+
+# --- 配置 ---
+# 每个分区的初始 / 最小 / 最大请求速率 (次/秒)。20 个分区并行时整体速率约为其 20 倍
+INITIAL_RATE = float(os.getenv("BAOSTOCK_RATE", 10))
+MIN_RATE = float(os.getenv("BAOSTOCK_MIN_RATE", 1))
+MAX_RATE = float(os.getenv("BAOSTOCK_MAX_RATE", 50))
+# 令牌桶容量 (允许的突发请求数)
+BURST = max(1.0, float(os.getenv("BAOSTOCK_BURST", 5)))
+# 每次成功请求后速率的加性增量 (次/秒)
+RATE_INCREASE = 0.2
+# 拥塞时速率与在途上限的乘性减小系数，以及两次减小之间的最短间隔 (秒，避免同一波错误连续减半)
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN_SECONDS = 1.0
+# 成功请求的延迟超过该值时也视为拥塞信号
+LATENCY_TARGET_SECONDS = float(os.getenv("BAOSTOCK_LATENCY_TARGET", 2.0))
+# 单次请求 (不含整只股票层面的重试) 的最大尝试次数，以及退避的基础/上限等待时间 (秒)
+CALL_MAX_ATTEMPTS = max(1, int(os.getenv("BAOSTOCK_CALL_MAX_ATTEMPTS", 4)))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 30.0
+# 限流错误的退避基数更大，给服务端留出恢复时间
+THROTTLE_BACKOFF_BASE_SECONDS = 2.0
+
+# 错误分类
+SESSION = "session"        # 会话失效/未登录：重新登录后重试
+THROTTLE = "throttle"      # 服务端限流：降速并较长时间退避后重试
+TRANSIENT = "transient"    # 网络错误等暂时性故障：退避后重试
+FATAL = "fatal"            # 参数错误等，重试也不会成功
+# baostock 的错误码: 10001001 = 用户未登录; 10002xxx = 网络错误; 10004xxx = 参数错误
+SESSION_ERROR_CODES = ("10001001",)
+TRANSIENT_ERROR_PREFIXES = ("10002",)
+FATAL_ERROR_PREFIXES = ("10004",)
+THROTTLE_MESSAGE_KEYWORDS = ("频繁", "限流", "过多", "too many", "rate limit")
+
+
+def classify_error(error_code, error_msg=""):
+    """把 baostock 返回的 error_code / error_msg 归类为 SESSION / THROTTLE / TRANSIENT / FATAL"""
+    message = (error_msg or "").lower()
+    if error_code in SESSION_ERROR_CODES or "未登录" in message:
+        return SESSION
+    if any(keyword in message for keyword in THROTTLE_MESSAGE_KEYWORDS):
+        return THROTTLE
+    if error_code.startswith(FATAL_ERROR_PREFIXES):
+        return FATAL
+    # 网络错误与未知错误码都按暂时性故障处理
+    return TRANSIENT
+
+
+class BaostockError(Exception):
+    """baostock 请求失败 (已按分类重试过)，kind 为错误分类"""
+
+    def __init__(self, error_code, error_msg, kind):
+        super().__init__(f"[{error_code}] {error_msg}")
+        self.error_code = error_code
+        self.error_msg = error_msg
+        self.kind = kind
+
+
+def backoff_seconds(attempt, kind=TRANSIENT):
+    """第 attempt 次失败后的等待时间：全抖动 (full jitter) 指数退避，避免多个进程同时重试"""
+    base = THROTTLE_BACKOFF_BASE_SECONDS if kind == THROTTLE else BACKOFF_BASE_SECONDS
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, base * 2 ** (attempt - 1)))
+
+
+class AdaptiveLimiter:
+    """
+    跨进程共享的自适应限流器：令牌桶控制请求速率，另设在途请求上限控制并发。
+    状态放在 multiprocessing.Array 中，须在主进程创建后作为参数传给工作进程。
+    """
+
+    # 共享状态数组中各字段的位置
+    _RATE, _TOKENS, _REFILLED_AT, _IN_FLIGHT, _LIMIT, _DECREASED_AT = range(6)
+
+    def __init__(self, max_concurrency, rate=INITIAL_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE, burst=BURST):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_rate = min_rate
+        self.max_rate = max(min_rate, max_rate)
+        self.burst = burst
+        rate = min(self.max_rate, max(self.min_rate, rate))
+        self._state = multiprocessing.Array(
+            "d", [rate, burst, time.monotonic(), 0, self.max_concurrency, 0.0])
+
+    @property
+    def rate(self):
+        return self._state[self._RATE]
+
+    @property
+    def concurrency_limit(self):
+        return int(self._state[self._LIMIT])
+
+    def _refill(self, now):
+        s = self._state
+        s[self._TOKENS] = min(self.burst, s[self._TOKENS] + (now - s[self._REFILLED_AT]) * s[self._RATE])
+        s[self._REFILLED_AT] = now
+
+    def acquire(self):
+        """阻塞直到拿到一个令牌且在途请求数低于当前上限，返回等待的秒数"""
+        t0 = time.monotonic()
+        s = self._state
+        while True:
+            with s.get_lock():
+                now = time.monotonic()
+                self._refill(now)
+                if s[self._TOKENS] >= 1 and s[self._IN_FLIGHT] < int(s[self._LIMIT]):
+                    s[self._TOKENS] -= 1
+                    s[self._IN_FLIGHT] += 1
+                    return now - t0
+                wait = (1 - s[self._TOKENS]) / s[self._RATE] if s[self._TOKENS] < 1 else 0.01
+            time.sleep(min(max(wait, 0.001), 0.1))
+
+    def release(self, congested):
+        """
+        请求结束时调用。congested 为 True (限流/网络错误/延迟超标) 时乘性减小速率与在途上限，
+        否则加性增加: 速率 + RATE_INCREASE，在途上限每轮约 + 1 (每次成功 + 1/上限)。
+        """
+        s = self._state
+        with s.get_lock():
+            s[self._IN_FLIGHT] = max(0, s[self._IN_FLIGHT] - 1)
+            now = time.monotonic()
+            if congested:
+                if now - s[self._DECREASED_AT] >= DECREASE_COOLDOWN_SECONDS:
+                    self._refill(now)
+                    s[self._RATE] = max(self.min_rate, s[self._RATE] * DECREASE_FACTOR)
+                    s[self._LIMIT] = max(1, s[self._LIMIT] * DECREASE_FACTOR)
+                    s[self._DECREASED_AT] = now
+            else:
+                self._refill(now)
+                s[self._RATE] = min(self.max_rate, s[self._RATE] + RATE_INCREASE)
+                s[self._LIMIT] = min(self.max_concurrency, s[self._LIMIT] + 1 / s[self._LIMIT])
+
+
+class RequestScheduler:
+    """
+    单个下载进程使用的请求入口：每次调用先向共享限流器申请配额，
+    再按错误分类重试 —— 会话失效时调用 login() 重新登录，限流/网络错误时带抖动退避，参数错误直接抛出。
+    """
+
+    def __init__(self, limiter, login, metrics=None, max_attempts=CALL_MAX_ATTEMPTS):
+        self.limiter = limiter
+        self.login = login
+        self.metrics = metrics
+        self.max_attempts = max_attempts
+
+    def _incr(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    def relogin(self):
+        lg = self.login()
+        self._incr("relogins")
+        if lg.error_code != '0':
+            raise BaostockError(lg.error_code, f"重新登录失败: {lg.error_msg}", SESSION)
+
+    def call(self, query, *args, **kwargs):
+        """调用 query(*args, **kwargs) 并返回 error_code 为 '0' 的结果集；重试用尽或不可重试时抛出 BaostockError"""
+        for attempt in range(1, self.max_attempts + 1):
+            waited = self.limiter.acquire()
+            if self.metrics is not None:
+                self.metrics.add_time("rate_limit_wait", waited)
+            t0 = time.monotonic()
+            congested = True
+            try:
+                rs = query(*args, **kwargs)
+                latency = time.monotonic() - t0
+                kind = None if rs.error_code == '0' else classify_error(rs.error_code, rs.error_msg)
+                congested = kind in (THROTTLE, TRANSIENT) or latency > LATENCY_TARGET_SECONDS
+            finally:
+                self.limiter.release(congested)
+
+            if kind is None:
+                return rs
+            self._incr("api_errors")
+            self._incr(f"api_errors_{kind}")
+            if kind == FATAL or attempt == self.max_attempts:
+                raise BaostockError(rs.error_code, rs.error_msg, kind)
+            self._incr("call_retries")
+            if kind == SESSION:
+                self.relogin()
+            else:
+                time.sleep(backoff_seconds(attempt, kind))